@@ -0,0 +1,248 @@
+#
+# Vectorized baseline agents.
+#
+# Batch agents take N stacked observations (N, OBS_SIZE) and action masks (N, TOTAL_ACTIONS),
+# in the flat layouts of BriscolaChiamata.flatten_observation / flatten_action_mask, and
+# return N flat action indexes with a few numpy operations, whatever the phase of each game.
+# They can also be used as regular agents, one observation at a time, through act().
+#
+import numpy as np
+
+from BriscolaChiamata import ACTION_OFFSETS, BID_ACTIONS, CHOOSE_TRUMP_ACTIONS, OBS_SLICES, TRICK_ACTIONS, \
+    flatten_action_mask, flatten_observation, action_from_index
+from Game import Deck, GameState
+
+N_SUITS = len(Deck.suits)
+N_RANKS = len(Deck.ranks)
+RANK_POINTS = np.array([r.points for r in Deck.ranks])
+PASS = BID_ACTIONS - 1
+
+BID_SLICE = slice(ACTION_OFFSETS[GameState.BIDDING], ACTION_OFFSETS[GameState.BIDDING] + BID_ACTIONS)
+TRUMP_SLICE = slice(ACTION_OFFSETS[GameState.CHOOSE_TRUMP], ACTION_OFFSETS[GameState.CHOOSE_TRUMP] + CHOOSE_TRUMP_ACTIONS)
+CARD_SLICE = slice(ACTION_OFFSETS[GameState.TRICK], ACTION_OFFSETS[GameState.TRICK] + TRICK_ACTIONS)
+
+
+def random_choice(mask, rng):
+    """
+    :return: for each row of the bool matrix mask, the index of a uniformly drawn True column (0 if none)
+    """
+    keys = rng.random(mask.shape)
+    keys[~mask] = -1
+    return keys.argmax(axis=1)
+
+
+def by_suit(a):
+    # (N, 40) card-indexed array -> (N, 4, 10), card index being suit * 10 + rank
+    return a.reshape(a.shape[0], N_SUITS, N_RANKS)
+
+
+class BatchAgent:
+    """
+    Uniform random agent. Subclasses override the decisions of the phases they play differently.
+    :param bidder: optional BatchAgent taking the bidding and trump decisions in place of this one
+    """
+
+    def __init__(self, player_id=None, seed=None, bidder=None):
+        self.player_id = player_id
+        self.rng = np.random.default_rng(seed)
+        self.bidder = bidder
+
+    def reset(self):
+        pass
+
+    def act(self, obs):
+        x = flatten_observation(obs['observation'])
+        m = flatten_action_mask(obs['action_mask'])
+        return action_from_index(int(self.act_batch(x[None, :], m[None, :])[0]))
+
+    def act_batch(self, obs, mask):
+        """
+        :param obs: (N, OBS_SIZE) observations
+        :param mask: (N, TOTAL_ACTIONS) bool action masks
+        :return: (N,) flat action indexes
+        """
+        obs = np.asarray(obs)
+        mask = np.asarray(mask, dtype=bool)
+        phase = obs[:, OBS_SLICES['gamestate']].argmax(axis=1)
+        actions = np.zeros(len(obs), dtype=np.int64)
+        decide = {
+            GameState.BIDDING: (self.bid if (self.bidder is None) else self.bidder.bid, BID_SLICE),
+            GameState.CHOOSE_TRUMP: (self.choose_trump if (self.bidder is None) else self.bidder.choose_trump,
+                                     TRUMP_SLICE),
+            GameState.TRICK: (self.play, CARD_SLICE),
+        }
+        for state, (fn, sl) in decide.items():
+            rows = np.flatnonzero(phase == state)
+            if (len(rows) > 0):
+                actions[rows] = sl.start + fn(obs[rows], mask[rows, sl])
+        return actions
+
+    # Each decision gets the observations and the mask of its own phase only,
+    # and returns indexes relative to that phase
+
+    def bid(self, obs, mask):
+        return random_choice(mask, self.rng)
+
+    def choose_trump(self, obs, mask):
+        return random_choice(mask, self.rng)
+
+    def play(self, obs, mask):
+        return random_choice(mask, self.rng)
+
+
+def card_cost(obs):
+    """
+    :return: (N, 40) cost of giving away each card: trumps cost more than any other card, then by rank
+    """
+    trump = obs[:, OBS_SLICES['trump']].astype(bool)
+    ranks = np.broadcast_to(np.arange(N_RANKS), (len(obs), N_SUITS, N_RANKS))
+    return (ranks + N_RANKS * trump[:, :, None]).reshape(len(obs), -1)
+
+
+class LowestCardBatchAgent(BatchAgent):
+    """
+    Always plays its lowest card (non-trumps first)
+    """
+
+    def play(self, obs, mask):
+        cost = np.where(mask, card_cost(obs), np.iinfo(np.int64).max)
+        return cost.argmin(axis=1)
+
+
+class CheapWinBatchAgent(BatchAgent):
+    """
+    Wins the trick with the cheapest card that can take it, otherwise plays its lowest card
+    """
+
+    def play(self, obs, mask):
+        n = len(obs)
+        trump = obs[:, OBS_SLICES['trump']].astype(bool)
+        lead = obs[:, OBS_SLICES['lead_suit']].astype(bool)
+        trick = by_suit(obs[:, OBS_SLICES['current_trick']].astype(bool))
+        ranks = np.arange(N_RANKS)
+
+        # Best rank on the table among trumps and among cards of the lead suit (-1 if none)
+        trick_trumps = trick & trump[:, :, None]
+        trick_lead = trick & lead[:, :, None]
+        best_trump = np.where(trick_trumps, ranks, -1).max(axis=(1, 2))
+        best_lead = np.where(trick_lead, ranks, -1).max(axis=(1, 2))
+
+        # A card wins if it is a higher trump than the trumps played, or if no trump has been played
+        # and it is either a trump or a higher card of the lead suit
+        higher = ranks[None, None, :] > np.where(trump[:, :, None], best_trump[:, None, None],
+                                                 best_lead[:, None, None])
+        no_trump_played = (best_trump < 0)[:, None, None]
+        wins = (trump[:, :, None] & higher) | \
+               (no_trump_played & ~trump[:, :, None] & lead[:, :, None] & higher)
+        # The first player of a trick has nothing to beat
+        wins &= lead.any(axis=1)[:, None, None]
+        wins = wins.reshape(n, -1) & mask
+
+        cost = card_cost(obs)
+        big = np.iinfo(np.int64).max
+        cheapest_win = np.where(wins, cost, big).argmin(axis=1)
+        lowest = np.where(mask, cost, big).argmin(axis=1)
+        return np.where(wins.any(axis=1), cheapest_win, lowest)
+
+
+class HandStrengthBatchAgent(BatchAgent):
+    """
+    Bids according to the strength of its hand: the points in hand plus a bonus for each card of
+    its longest suit. It keeps bidding the highest rank still available as long as it is not below
+    the rank its strength allows. As trump it chooses the suit where it is strongest among those
+    where it does not hold the called rank, so that the partner is someone else, unless that suit
+    is strong enough (solo_threshold) to play alone.
+    """
+
+    def __init__(self, player_id=None, seed=None, bidder=None, threshold=30, step=5, length_bonus=3,
+                 solo_threshold=40):
+        super().__init__(player_id, seed, bidder)
+        self.threshold = threshold
+        self.step = step
+        self.length_bonus = length_bonus
+        self.solo_threshold = solo_threshold
+
+    def suit_strength(self, obs):
+        hand = by_suit(obs[:, OBS_SLICES['player_hand']].astype(bool))
+        return (hand * RANK_POINTS).sum(axis=2) + self.length_bonus * hand.sum(axis=2)
+
+    def bid(self, obs, mask):
+        hand = by_suit(obs[:, OBS_SLICES['player_hand']].astype(bool))
+        strength = (hand * RANK_POINTS).sum(axis=(1, 2)) + self.length_bonus * hand.sum(axis=2).max(axis=1)
+        # Lowest rank the player is willing to call, from Asso (9) down
+        lowest_rank = N_RANKS - 1 - (strength - self.threshold) // self.step
+        ranks = mask[:, :N_RANKS]
+        highest_legal = np.where(ranks, np.arange(N_RANKS), -1).max(axis=1)
+        go = (strength >= self.threshold) & (highest_legal >= 0) & (highest_legal >= lowest_rank)
+        return np.where(go, highest_legal, PASS)
+
+    def choose_trump(self, obs, mask):
+        strength = np.where(mask, self.suit_strength(obs), -1)
+        hand = by_suit(obs[:, OBS_SLICES['player_hand']].astype(bool))
+        called = obs[:, OBS_SLICES['highest_bid']].argmax(axis=1)
+        # Suits where the player holds the called card: choosing one of them means playing alone
+        solo = hand[np.arange(len(obs)), :, called]
+        partnered = np.where(solo, -1, strength)
+        alone = np.where(solo, strength, -1)
+        go_solo = (alone.max(axis=1) >= self.solo_threshold) | (partnered.max(axis=1) < 0)
+        return np.where(go_solo, alone.argmax(axis=1), partnered.argmax(axis=1))
+
+
+BATCH_AGENTS = {
+    'batch_random': BatchAgent,
+    'lowest_card': LowestCardBatchAgent,
+    'cheap_win': CheapWinBatchAgent,
+    'hand_strength': HandStrengthBatchAgent,
+}
+
+
+#
+# TESTS
+#
+
+def test_cheap_win():
+    from BriscolaChiamata import OBS_SIZE, TOTAL_ACTIONS
+
+    def card(r, s):
+        return s * N_RANKS + r
+
+    obs = np.zeros((1, OBS_SIZE), np.float32)
+    mask = np.zeros((1, TOTAL_ACTIONS), bool)
+    obs[0, OBS_SLICES['gamestate'].start + GameState.TRICK] = 1
+    obs[0, OBS_SLICES['trump'].start + 1] = 1
+    # Lead suit 0, a 7 of suit 0 on the table
+    obs[0, OBS_SLICES['lead_suit'].start + 0] = 1
+    obs[0, OBS_SLICES['current_trick'].start + card(4, 0)] = 1
+    # In hand: 2 and Re of suit 0, 2 of trump, Asso of suit 2
+    for c in (card(0, 0), card(7, 0), card(0, 1), card(9, 2)):
+        obs[0, OBS_SLICES['player_hand'].start + c] = 1
+        mask[0, CARD_SLICE.start + c] = 1
+    assert (CheapWinBatchAgent().act_batch(obs, mask)[0] == CARD_SLICE.start + card(7, 0))
+    assert (LowestCardBatchAgent().act_batch(obs, mask)[0] == CARD_SLICE.start + card(0, 0))
+
+    # A trump on the table: only a higher trump wins, otherwise the lowest card is played
+    obs[0, OBS_SLICES['current_trick'].start + card(5, 1)] = 1
+    assert (CheapWinBatchAgent().act_batch(obs, mask)[0] == CARD_SLICE.start + card(0, 0))
+
+
+def test_choose_trump():
+    from BriscolaChiamata import OBS_SIZE
+
+    obs = np.zeros((2, OBS_SIZE), np.float32)
+    obs[:, OBS_SLICES['gamestate'].start + GameState.CHOOSE_TRUMP] = 1
+    # Asso called; the player has Asso, Tre and Re of suit 0 and two low cards of suit 1
+    obs[:, OBS_SLICES['highest_bid'].start + 9] = 1
+    for c in (9, 8, 7, 10 + 0, 10 + 1):
+        obs[:, OBS_SLICES['player_hand'].start + c] = 1
+    # ...and, in the second game, all the other points of suit 0: strong enough to play alone
+    for c in (6, 5):
+        obs[1, OBS_SLICES['player_hand'].start + c] = 1
+    mask = np.zeros((2, CHOOSE_TRUMP_ACTIONS), bool)
+    mask[:] = 1
+    agent = HandStrengthBatchAgent()
+    assert (agent.choose_trump(obs, mask).tolist() == [1, 0])
+
+
+if __name__ == "__main__":
+    test_cheap_win()
+    test_choose_trump()
@@ -8,7 +8,8 @@ from pettingzoo.utils import wrappers
 #
 # Env definition
 #
-from Game import Game, Deck, GameAction, GameState, Bid, BidType, Rank
+from DealBank import DealBank, episode_rng, generate_deals
+from Game import Game, Deck, GameAction, GameState, Bid, BidType, Rank, Rules
 
 
 def env():
@@ -33,6 +34,86 @@ CHOOSE_TRUMP_ACTIONS = 4
 BID_ACTIONS = 11
 TOTAL_ACTIONS = BID_ACTIONS + CHOOSE_TRUMP_ACTIONS + TRICK_ACTIONS
 
+# Flat (stacked) layout of the actions of all phases, used by batch agents and trainers
+# working with arrays rather than dicts: [bids | trump suits | cards]
+ACTION_OFFSETS = {
+    GameState.BIDDING: 0,
+    GameState.CHOOSE_TRUMP: BID_ACTIONS,
+    GameState.TRICK: BID_ACTIONS + CHOOSE_TRUMP_ACTIONS
+}
+# Flat layout of the observation: (key, size), gamestate being one-hot encoded
+OBS_FIELDS = [
+    ('gamestate', len(GameState)),
+    ('player_hand', TRICK_ACTIONS),
+    ('trump', CHOOSE_TRUMP_ACTIONS),
+    ('current_trick', TRICK_ACTIONS),
+    ('lead_suit', CHOOSE_TRUMP_ACTIONS),
+    ('caller', Rules.NUM_PLAYERS),
+    ('partner_card', TRICK_ACTIONS),
+    ('highest_bid', len(Deck.ranks))
+]
+# Layout of the observation as flattened by the rllib preprocessor, i.e. as seen by the models
+# (ParametricActionsModel): gym sorts the keys of Dict spaces, and Discrete spaces are one-hot encoded.
+# The logits of the models follow the flat action layout above, the keys of the action Dict being the GameState.
+MODEL_OBS_FIELDS = sorted(OBS_FIELDS)
+
+
+def obs_slices(fields):
+    """
+    :return: (dict key -> slice, total size) of a flat observation layout
+    """
+    slices = {}
+    size = 0
+    for key, n in fields:
+        slices[key] = slice(size, size + n)
+        size += n
+    return slices, size
+
+
+OBS_SLICES, OBS_SIZE = obs_slices(OBS_FIELDS)
+
+
+def flatten_action_mask(mask):
+    """
+    :param mask: action mask dict, as in the observations of BriscolaChiamataEnv
+    :return: a (TOTAL_ACTIONS,) bool array with the masks of all the phases stacked
+    """
+    return np.concatenate([
+        mask[GameState.BIDDING],
+        mask[GameState.CHOOSE_TRUMP],
+        mask[GameState.TRICK][:TRICK_ACTIONS]
+    ]).astype(bool)
+
+
+def flatten_observation(obs, fields=OBS_FIELDS):
+    """
+    :param obs: the 'observation' dict of an observation of BriscolaChiamataEnv
+    :param fields: the flat layout, OBS_FIELDS or MODEL_OBS_FIELDS
+    :return: a (OBS_SIZE,) float32 array
+    """
+    x = np.zeros(OBS_SIZE, np.float32)
+    start = 0
+    for key, size in fields:
+        if (key == 'gamestate'):
+            x[start + int(obs[key])] = 1
+        else:
+            x[start:start + size] = obs[key]
+        start += size
+    return x
+
+
+def action_from_index(a):
+    """
+    :param a: index of an action in the flat layout
+    :return: the action dict accepted by BriscolaChiamataEnv.step
+    """
+    d = {GameState.BIDDING: 0, GameState.CHOOSE_TRUMP: 0, GameState.TRICK: 0}
+    for state in (GameState.TRICK, GameState.CHOOSE_TRUMP, GameState.BIDDING):
+        if (a >= ACTION_OFFSETS[state]):
+            d[state] = int(a - ACTION_OFFSETS[state])
+            break
+    return d
+
 
 #
 # TODO: this Env should be as independent as possible from
@@ -51,7 +132,8 @@ class BriscolaChiamataEnv(AECEnv):
     '''
     metadata = {'render.modes': ['human'], "name": "bc_v0"}
 
-    def __init__(self):
+    def __init__(self, position_bank=None, deal_bank=None, worker_index=0, num_workers=1,
+                 trick_only=False, bidding_agent=None, listeners=(), vector_index=0, num_envs_per_worker=1):
         '''
         The init method takes in environment arguments and
          should define the following attributes:
@@ -60,10 +142,38 @@ class BriscolaChiamataEnv(AECEnv):
         - observation_spaces
 
         These attributes should not be changed after initialization.
+
+        position_bank: optional PositionBank; if set, reset() starts each game from a
+        position sampled from it instead of dealing a new game
+        deal_bank: optional path of a deal bank (see DealBank.generate); if not set, deals
+        are generated on the fly
+        worker_index, num_workers: index of the worker running this env, and the number of workers
+        vector_index, num_envs_per_worker: index of this env among the vector envs of its worker, and their number;
+        each (worker, vector env, episode) gets an independent random stream (or its own slice of the deal bank)
+        trick_only: if True, bidding and trump choice are resolved inside reset() by bidding_agent
+        (an agent with an act(obs) method, used for every seat; by default HandStrengthBatchAgent, which
+        calls a card it does not hold, so that solo games stay as rare as in real play),
+        so that agents only act in the trick phase
+        listeners: GameListener objects (e.g. GameStats) added to the game
         '''
         super().__init__()
-        self.rng_seed = random.randint(0, 2 ** 32 - 1)
+        self.trick_only = trick_only
+        if (trick_only and bidding_agent is None):
+            from BatchAgents import HandStrengthBatchAgent
+            bidding_agent = HandStrengthBatchAgent()
+        self.bidding_agent = bidding_agent
+        self.position_bank = position_bank
+        self.worker_index = worker_index
+        self.vector_index = vector_index
+        self.num_workers = num_workers
+        self.deal_bank = None if (deal_bank is None) else \
+            DealBank(deal_bank, worker_index, num_workers, vector_index, num_envs_per_worker)
+        self.seed(random.randint(0, 2 ** 32 - 1))
         self.game = Game()
+        # When all players pass, the cards are dealt again from the same source as the episodes
+        self.game.deal_source = self.next_deal
+        for l in listeners:
+            self.game.add_listener(l)
         self.agents = ["player_" + str(r) for r in range(self.game.np)]
         self.possible_agents = self.agents[:]
         self.agent_name_mapping = dict(zip(self.agents, list(range(len(self.agents)))))
@@ -78,7 +188,15 @@ class BriscolaChiamataEnv(AECEnv):
             # TODO: very preliminary for now
             'observation': Dict({
                 'gamestate': Discrete(len(GameState)),
-                'player_hand': Box(low=0, high=1, shape=(TRICK_ACTIONS,), dtype=bool)
+                'player_hand': Box(low=0, high=1, shape=(TRICK_ACTIONS,), dtype=bool),
+                'trump': Box(low=0, high=1, shape=(CHOOSE_TRUMP_ACTIONS,), dtype=bool),
+                'current_trick': Box(low=0, high=1, shape=(TRICK_ACTIONS,), dtype=bool),
+                'lead_suit': Box(low=0, high=1, shape=(CHOOSE_TRUMP_ACTIONS,), dtype=bool),
+                # Bid outcome: seat of the caller relative to the player, and the card called
+                'caller': Box(low=0, high=1, shape=(self.game.np,), dtype=bool),
+                'partner_card': Box(low=0, high=1, shape=(TRICK_ACTIONS,), dtype=bool),
+                # Rank of the highest bid so far (the rank of the partner card, once the bidding is over)
+                'highest_bid': Box(low=0, high=1, shape=(len(Deck.ranks),), dtype=bool)
             }),
             'action_mask': Dict({
                 GameState.BIDDING:      Box(low=0, high=1, shape=(BID_ACTIONS,), dtype=bool),
@@ -96,8 +214,14 @@ class BriscolaChiamataEnv(AECEnv):
 
     def seed(self, seed=1):
         self.rng_seed = seed
-
-    def reset(self):
+        self.episode = 0
+        if (self.deal_bank is not None):
+            self.deal_bank.seed(seed)
+        # Stored positions are drawn from a stream of their own, seeded once rather than at every reset
+        ss = np.random.SeedSequence(seed, spawn_key=(self.worker_index, self.vector_index))
+        self.position_rng = random.Random(int(ss.generate_state(1, np.uint64)[0]))
+
+    def reset(self, position=None):
         """
          Reset needs to initialize the following attributes
         - agents
@@ -109,6 +233,8 @@ class BriscolaChiamataEnv(AECEnv):
         And must set up the environment so that render(), step(), and observe()
         can be called without issues.
 
+        position: optional game position (as returned by Game.get_state) to start from,
+        e.g. a specific deal, bidding outcome, trump or mid-trick state
         """
         self.agents = self.possible_agents[:]
         self.dones = {agent: False for agent in self.agents}
@@ -116,10 +242,40 @@ class BriscolaChiamataEnv(AECEnv):
         self.rewards = {agent: 0 for agent in self.agents}
         self._cumulative_rewards = {agent: 0 for agent in self.agents}
 
-        self.game.seed(self.rng_seed)
-        self.game.init_game()
+        rng = episode_rng(self.rng_seed, self.worker_index, self.episode, self.vector_index)
+        self.game.seed(int(rng.integers(0, 2 ** 63)))
+        if (position is None and self.position_bank is not None):
+            position = self.position_bank.sample(self.position_rng)
+        if (position is not None):
+            self.game.set_state(position)
+            self.episode += 1
+        else:
+            self.game.init_game(self.next_deal(rng))
+        if (self.trick_only):
+            self.play_bidding()
         self.agent_selection = self.agents[self.game.current_player]
 
+    def next_deal(self, rng=None):
+        """
+        :param rng: the random stream of the current episode, if already created
+        :return: the next deal, from the deal bank or from the random stream of the episode; each deal
+                 (including those of the games where all players passed) uses up an episode index
+        """
+        if (self.deal_bank is not None):
+            deal = self.deal_bank.deal(self.episode)
+        else:
+            if (rng is None):
+                rng = episode_rng(self.rng_seed, self.worker_index, self.episode, self.vector_index)
+            deal = generate_deals(rng, 1)[0]
+        self.episode += 1
+        return deal
+
+    def play_bidding(self):
+        # Scripted bidding and trump choice: the game goes straight to the trick phase
+        while (self.game.gamestate != GameState.TRICK):
+            agent = self.agents[self.game.current_player]
+            self.game.step(self.convert_action(self.bidding_agent.act(self.observe(agent))))
+
     def convert_action(self, action):
         state = self.game.gamestate
         a = action[state]
@@ -183,8 +339,29 @@ class BriscolaChiamataEnv(AECEnv):
         bid_mask   = np.zeros(BID_ACTIONS, 'bool')
         ct_mask    = np.zeros(CHOOSE_TRUMP_ACTIONS, 'bool')
         trick_mask = np.zeros(TRICK_ACTIONS, 'bool')
+        player_hand = np.zeros(TRICK_ACTIONS, 'bool')
+        trump = np.zeros(CHOOSE_TRUMP_ACTIONS, 'bool')
+        current_trick = np.zeros(TRICK_ACTIONS, 'bool')
+        lead_suit = np.zeros(CHOOSE_TRUMP_ACTIONS, 'bool')
+        caller = np.zeros(self.game.np, 'bool')
+        partner_card = np.zeros(TRICK_ACTIONS, 'bool')
+        bid_rank = np.zeros(len(Deck.ranks), 'bool')
 
         game = self.game
+        if (game.caller is not None):
+            caller[(game.caller - self.agent_name_mapping[agent]) % game.np] = 1
+        if (game.partner_card is not None):
+            partner_card[Deck.get_index_from_card(game.partner_card)] = 1
+        if (game.highest_bid.type == BidType.RANK):
+            bid_rank[game.highest_bid.rank.rank] = 1
+        for c in game.get_player_hand(self.agent_name_mapping[agent]):
+            player_hand[Deck.get_index_from_card(c)] = 1
+        if (game.trump is not None):
+            trump[Deck.suits.index(game.trump)] = 1
+        for c in game.current_trick:
+            current_trick[Deck.get_index_from_card(c)] = 1
+        if (len(game.current_trick) > 0):
+            lead_suit[Deck.suits.index(game.current_trick[0].suit)] = 1
         # Action masks
         if (game.gamestate == GameState.BIDDING):
             bid_mask[BID_ACTIONS - 1] = 1  # PASS is always legal
@@ -201,9 +378,7 @@ class BriscolaChiamataEnv(AECEnv):
         elif (game.gamestate == GameState.CHOOSE_TRUMP):
             ct_mask = np.ones(CHOOSE_TRUMP_ACTIONS, 'bool')
         elif (game.gamestate == GameState.TRICK):
-            hand = game.get_player_hand(self.agent_name_mapping[agent])
-            for c in hand:
-                trick_mask[Deck.get_index_from_card(c)] = 1
+            trick_mask = player_hand.copy()
 
         mask_dict = {
             GameState.BIDDING: bid_mask,
@@ -212,7 +387,13 @@ class BriscolaChiamataEnv(AECEnv):
         }
         obs_dict = {
             'gamestate': game.gamestate,
-            'player_hand': trick_mask
+            'player_hand': player_hand,
+            'trump': trump,
+            'current_trick': current_trick,
+            'lead_suit': lead_suit,
+            'caller': caller,
+            'partner_card': partner_card,
+            'highest_bid': bid_rank
         }
         return {'observation': obs_dict, 'action_mask': mask_dict}
 
@@ -222,7 +403,8 @@ class BriscolaChiamataEnv(AECEnv):
         or any other environment data which should not be kept around after the
         user is no longer using the environment.
         '''
-        pass
+        for l in self.game.listeners:
+            l.close()
 
     #
     # Rendering related functions
@@ -313,3 +495,35 @@ class BriscolaChiamataEnv(AECEnv):
             s += self.render_trick_phase()
             print(s)
 
+
+#
+# TESTS
+#
+
+def test_trick_only():
+    from GameStats import GameStats
+    from RandomAgent import RandomAgent
+
+    def play(n_games, **kwargs):
+        stats = GameStats()
+        env = BriscolaChiamataEnv(listeners=[stats], **kwargs)
+        env.seed(0)
+        np.random.seed(0)
+        agents = [RandomAgent(i) for i in range(env.game.np)]
+        for g in range(n_games):
+            env.reset()
+            if (kwargs.get('trick_only')):
+                assert (env.game.gamestate == GameState.TRICK)
+            while (not env.game.done):
+                p = env.game.current_player
+                env.step(agents[p].act(env.observe(env.agents[p])))
+        return stats.summary()
+
+    # The scripted bidding keeps a realistic mix of partnered and solo games
+    s = play(300, trick_only=True)
+    assert (s['games'] == 300 and s['solo_rate'] < 0.1)
+    assert (s['solo_rate'] < play(300)['solo_rate'])
+
+
+if __name__ == "__main__":
+    test_trick_only()
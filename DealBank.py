@@ -0,0 +1,117 @@
+#
+# Deal generation with independent, reproducible random streams.
+#
+# A deal is an array of 41 uint8: the permutation of the 40 card indexes of the deck
+# (player i gets cards 8 * i ... 8 * i + 7) followed by the first player.
+# Each (worker, vector env, episode) triple gets its own PCG64 stream, derived from a
+# SeedSequence spawn key, so deals are reproducible and never repeat across any number
+# of parallel workers and vector envs. A DealBank pre-generates a large number of deals in a
+# memory-mapped .npy file, so that resets just index into it.
+#
+import numpy as np
+
+from Game import Rules
+
+N_CARDS = 40
+DEAL_SIZE = N_CARDS + 1
+
+
+def episode_rng(seed, worker_index, episode, vector_index=0):
+    """
+    :return: a numpy Generator independent of those of every other (worker_index, vector_index, episode)
+    """
+    ss = np.random.SeedSequence(seed, spawn_key=(worker_index, vector_index, episode))
+    return np.random.Generator(np.random.PCG64(ss))
+
+
+def generate_deals(rng, n):
+    """
+    :return: an (n, DEAL_SIZE) uint8 array of random deals
+    """
+    deals = np.empty((n, DEAL_SIZE), dtype=np.uint8)
+    deals[:, :N_CARDS] = rng.permuted(np.tile(np.arange(N_CARDS, dtype=np.uint8), (n, 1)), axis=1)
+    deals[:, N_CARDS] = rng.integers(0, Rules.NUM_PLAYERS, size=n)
+    return deals
+
+
+class DealBank:
+    """
+    Pre-generated deals, memory-mapped from a .npy file created with DealBank.generate.
+    Each of the num_workers * num_envs_per_worker envs gets its own slot s, and deals
+    o + s, o + s + n, o + s + 2n, ... (n being the number of slots), so envs never share a deal
+    until the bank wraps around. The offset o is derived from the seed (see seed()), so that
+    runs with different seeds go through the bank in a different order.
+    """
+
+    def __init__(self, path, worker_index=0, num_workers=1, vector_index=0, num_envs_per_worker=1):
+        self.deals = np.load(path, mmap_mode='r')
+        if (self.deals.ndim != 2 or self.deals.shape[1] != DEAL_SIZE):
+            raise Exception("DealBank: bad shape {0} in {1}".format(self.deals.shape, path))
+        if (worker_index >= num_workers or vector_index >= num_envs_per_worker):
+            # Slots would overlap with those of other envs
+            raise Exception("DealBank: env ({0}, {1}) out of {2} workers x {3} envs per worker".format(
+                worker_index, vector_index, num_workers, num_envs_per_worker))
+        self.slot = worker_index * num_envs_per_worker + vector_index
+        self.num_slots = num_workers * num_envs_per_worker
+        self.offset = 0
+
+    def seed(self, seed):
+        # Same offset for all the slots, so that they stay disjoint
+        self.offset = int(np.random.SeedSequence(seed).generate_state(1, np.uint64)[0] % len(self))
+
+    def __len__(self):
+        return self.deals.shape[0]
+
+    def deal(self, episode):
+        i = (self.offset + episode * self.num_slots + self.slot) % len(self)
+        return np.array(self.deals[i])
+
+    @staticmethod
+    def generate(path, n_deals, seed, chunk_size=100000):
+        """
+        Writes n_deals deals to path (a .npy file), generating them in chunks so that
+        the bank does not need to fit in memory
+        """
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(n_deals, DEAL_SIZE))
+        for i, start in enumerate(range(0, n_deals, chunk_size)):
+            n = min(chunk_size, n_deals - start)
+            rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=(i,))))
+            out[start:start + n] = generate_deals(rng, n)
+        out.flush()
+        del out
+
+
+#
+# TESTS
+#
+
+def test_deals():
+    import os
+    import tempfile
+
+    def deal(seed, worker_index, episode, vector_index=0):
+        return generate_deals(episode_rng(seed, worker_index, episode, vector_index), 1)[0]
+
+    d = deal(42, 1, 3)
+    assert (np.array_equal(d, deal(42, 1, 3)))
+    assert (not np.array_equal(d, deal(42, 1, 4)))
+    assert (not np.array_equal(d, deal(42, 2, 3)))
+    # Streams are keyed by (worker, vector env, episode), not by a flat index
+    assert (not np.array_equal(deal(42, 1, 3, vector_index=1), deal(42, 2, 3, vector_index=0)))
+    assert (sorted(d[:N_CARDS]) == list(range(N_CARDS)) and d[N_CARDS] < Rules.NUM_PLAYERS)
+
+    path = os.path.join(tempfile.mkdtemp(), "deals.npy")
+    DealBank.generate(path, 1000, seed=1, chunk_size=300)
+    banks = [DealBank(path, w, 2, v, 2) for w in range(2) for v in range(2)]
+    for b in banks:
+        b.seed(7)
+    seen = set(bytes(b.deal(e)) for b in banks for e in range(250))
+    assert (len(seen) == 1000)
+    # Another seed starts elsewhere in the bank
+    first = banks[0].deal(0)
+    banks[0].seed(8)
+    assert (not np.array_equal(first, banks[0].deal(0)))
+
+
+if __name__ == "__main__":
+    test_deals()
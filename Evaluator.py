@@ -0,0 +1,294 @@
+#
+# Non-blocking evaluation of training checkpoints.
+#
+# A background thread watches the checkpoint directory of a training run; each new
+# checkpoint is evaluated in a separate process pool by playing many seeded games
+# against configurable opponents, with the evaluated agent rotating through the seats.
+# Results are appended to a JSON lines file and can be polled by the training loop,
+# which is never blocked by the evaluation.
+#
+import json
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from BriscolaChiamata import BriscolaChiamataEnv
+from Game import Rules
+from BatchAgents import BATCH_AGENTS, CheapWinBatchAgent, HandStrengthBatchAgent
+from RandomAgent import RandomAgent
+
+# Opponent factories: (player_id, seed) -> agent
+OPPONENTS = dict(BATCH_AGENTS, **{
+    # RandomAgent draws from the global numpy generator, seeded by evaluate_chunk
+    'random': lambda player_id, seed: RandomAgent(player_id),
+    'scripted': lambda player_id, seed: CheapWinBatchAgent(player_id, seed,
+                                                           bidder=HandStrengthBatchAgent(player_id, seed)),
+})
+
+
+def play_games(agents, n_games, seed, seat_of):
+    """
+    Plays n_games seeded games.
+    :param agents: function (game_index, seat) -> agent with reset() and act(obs) methods
+    :param seat_of: function game_index -> seat of the evaluated agent
+    :return: list of dicts, one per game, with the seat of the evaluated agent and the outcome of the game
+    """
+    env = BriscolaChiamataEnv()
+    env.seed(seed)
+    results = []
+    for g in range(n_games):
+        env.reset()
+        players = [agents(g, i) for i in range(env.game.np)]
+        for p in players:
+            p.reset()
+        while (not env.game.done):
+            p = env.game.current_player
+            env.step(players[p].act(env.observe(env.agents[p])))
+        results.append({
+            'seat': seat_of(g),
+            'game_points': list(env.game.game_points),
+            'caller': env.game.caller,
+            'partner': env.game.partner
+        })
+    return results
+
+
+def summarize(results):
+    points = np.array([r['game_points'][r['seat']] for r in results], dtype=np.float64)
+    called = np.array([r['caller'] == r['seat'] for r in results])
+    return {
+        'games': len(results),
+        'mean_game_points': float(points.mean()) if (len(points) > 0) else 0.0,
+        'win_rate': float((points > 0).mean()) if (len(points) > 0) else 0.0,
+        'caller_rate': float(called.mean()) if (len(points) > 0) else 0.0,
+        'caller_win_rate': float((points[called] > 0).mean()) if (called.any()) else 0.0
+    }
+
+
+# Agents loaded in the current worker process, by checkpoint: loading e.g. an rllib trainer is expensive
+_loaded = {}
+
+
+def evaluate_chunk(loader, checkpoint, opponent, n_games, seed):
+    if (checkpoint not in _loaded):
+        _loaded.clear()
+        _loaded[checkpoint] = loader(checkpoint)
+    candidate = _loaded[checkpoint]
+    # RandomAgent draws from the global numpy generator
+    np.random.seed(seed)
+
+    def agents(g, i):
+        # Each opponent gets its own stream, derived from the chunk seed, the game and the seat
+        return candidate if (i == g % Rules.NUM_PLAYERS) else OPPONENTS[opponent](i, [seed, g, i])
+
+    return play_games(agents, n_games, seed, lambda g: g % Rules.NUM_PLAYERS)
+
+
+class RllibAgent:
+    """
+    Agent acting with the default policy of an rllib trainer restored from a checkpoint
+    """
+
+    def __init__(self, checkpoint, trainer_cls, config):
+        if (os.path.isdir(checkpoint)):
+            # rllib checkpoint directories contain a checkpoint-<n> file (and its .tune_metadata)
+            files = [f for f in os.listdir(checkpoint) if f.startswith("checkpoint-") and "." not in f]
+            checkpoint = os.path.join(checkpoint, files[0])
+        self.trainer = trainer_cls(config=config)
+        self.trainer.restore(checkpoint)
+
+    def reset(self):
+        pass
+
+    def act(self, obs):
+        return self.trainer.compute_single_action(obs, explore=False)
+
+
+def load_rllib_agent(checkpoint, trainer_cls, config, setup=None):
+    """
+    Loader for CheckpointEvaluator; setup is called first in the worker process (e.g. to register env and model)
+    """
+    if (setup is not None):
+        setup()
+    return RllibAgent(checkpoint, trainer_cls, config)
+
+
+class CheckpointEvaluator:
+    """
+    :param checkpoint_dir: directory watched (recursively) for new checkpoint_* directories
+    :param loader: picklable function checkpoint_path -> agent; it runs in freshly spawned worker
+                   processes, so it must set up anything it needs there (e.g. ray.init)
+    :param opponents: names of the opponents (see OPPONENTS) to evaluate against
+    :param n_games: games per checkpoint and opponent, split among the worker processes
+    :param include_existing: if False, checkpoints already in checkpoint_dir when start() is called
+                             (e.g. those of earlier experiments) are not evaluated
+    """
+
+    def __init__(self, checkpoint_dir, loader, opponents=('random',), n_games=2000, seed=0,
+                 n_workers=None, poll_interval=10.0, settle_time=5.0, metrics_file=None, include_existing=False):
+        self.checkpoint_dir = checkpoint_dir
+        self.loader = loader
+        self.opponents = list(opponents)
+        self.n_games = n_games
+        self.seed = seed
+        self.n_workers = max(1, (os.cpu_count() or 2) // 2) if (n_workers is None) else n_workers
+        self.poll_interval = poll_interval
+        # Checkpoints are evaluated once they have not been modified for settle_time seconds
+        self.settle_time = settle_time
+        self.metrics_file = os.path.join(checkpoint_dir, "eval_metrics.jsonl") if (metrics_file is None) \
+            else metrics_file
+        self.include_existing = include_existing
+        self.seen = set()
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.executor = None
+        self.thread = None
+
+    def start(self):
+        if (not self.include_existing):
+            self.seen.update(self.find_checkpoints())
+        # Workers are spawned rather than forked: the training process runs threads (and e.g. ray)
+        # whose state must not be copied into them
+        self.executor = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=mp.get_context("spawn"))
+        self.thread = threading.Thread(target=self._watch, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, wait=False):
+        self.stop_event.set()
+        # The watcher may be submitting a checkpoint: let it finish before the executor is shut down
+        if (self.thread is not None):
+            self.thread.join()
+        if (self.executor is not None):
+            self.executor.shutdown(wait=wait)
+
+    def find_checkpoints(self):
+        found = []
+        if (not os.path.isdir(self.checkpoint_dir)):
+            return found
+        for root, dirs, files in os.walk(self.checkpoint_dir):
+            for d in dirs:
+                if (d.startswith("checkpoint_")):
+                    found.append(os.path.join(root, d))
+        return sorted(found)
+
+    def is_ready(self, checkpoint):
+        files = [os.path.join(checkpoint, f) for f in os.listdir(checkpoint)]
+        if (len(files) == 0):
+            return False
+        return time.time() - max(os.path.getmtime(f) for f in files) > self.settle_time
+
+    def _watch(self):
+        while (not self.stop_event.is_set()):
+            for checkpoint in self.find_checkpoints():
+                if (self.stop_event.is_set()):
+                    break
+                try:
+                    ready = checkpoint not in self.seen and self.is_ready(checkpoint)
+                except OSError:
+                    # Removed or renamed meanwhile (e.g. by keep_checkpoints_num, or a temporary file):
+                    # it is looked at again at the next poll, if still there
+                    continue
+                if (ready):
+                    self.seen.add(checkpoint)
+                    self._submit(checkpoint)
+            self.stop_event.wait(self.poll_interval)
+
+    def _submit(self, checkpoint):
+        chunk = -(-self.n_games // self.n_workers)
+        for opponent in self.opponents:
+            futures = []
+            for i, start in enumerate(range(0, self.n_games, chunk)):
+                n = min(chunk, self.n_games - start)
+                futures.append(self.executor.submit(evaluate_chunk, self.loader, checkpoint, opponent, n,
+                                                    self.seed + i))
+            self._collect(checkpoint, opponent, futures)
+
+    def _collect(self, checkpoint, opponent, futures):
+        pending = {'n': len(futures), 'results': [], 'start': time.time()}
+        lock = threading.Lock()
+
+        def done(f):
+            with lock:
+                if (f.cancelled() or f.exception() is not None):
+                    pending['error'] = repr(f.exception()) if (not f.cancelled()) else "cancelled"
+                else:
+                    pending['results'].extend(f.result())
+                pending['n'] -= 1
+                if (pending['n'] > 0):
+                    return
+            metrics = dict(summarize(pending['results']), checkpoint=checkpoint, opponent=opponent,
+                           eval_time=time.time() - pending['start'])
+            if ('error' in pending):
+                metrics['error'] = pending['error']
+            self._publish(metrics)
+
+        for f in futures:
+            f.add_done_callback(done)
+
+    def _publish(self, metrics):
+        with self.lock:
+            with open(self.metrics_file, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
+        self.results.put(metrics)
+
+    def poll(self):
+        """
+        :return: the list of evaluation results completed since the last call (never blocks)
+        """
+        out = []
+        while True:
+            try:
+                out.append(self.results.get_nowait())
+            except queue.Empty:
+                return out
+
+
+def checkpoint_iteration(checkpoint):
+    """
+    :return: the training iteration of an rllib checkpoint directory (checkpoint_000042 -> 42)
+    """
+    try:
+        return int(os.path.basename(checkpoint).split("_")[-1])
+    except ValueError:
+        return -1
+
+
+def flatten_metrics(metrics):
+    """
+    :return: the metrics of an evaluation as a flat dict, for the training loggers
+    """
+    prefix = "async_eval/{0}/".format(metrics['opponent'])
+    out = {prefix + k: v for k, v in metrics.items() if isinstance(v, (int, float))}
+    out[prefix + 'checkpoint_iteration'] = checkpoint_iteration(metrics['checkpoint'])
+    return out
+
+
+
+#
+# TESTS
+#
+
+def test_checkpoint_evaluator():
+    import tempfile
+
+    d = tempfile.mkdtemp()
+    evaluator = CheckpointEvaluator(d, RandomAgent, poll_interval=0.05)
+    # A checkpoint removed between the scan and the readiness check does not kill the watcher
+    evaluator.find_checkpoints = lambda: [os.path.join(d, "checkpoint_000001")]
+    evaluator.thread = threading.Thread(target=evaluator._watch, daemon=True)
+    evaluator.thread.start()
+    time.sleep(0.3)
+    assert (evaluator.thread.is_alive())
+    evaluator.stop()
+    assert (not evaluator.thread.is_alive() and len(evaluator.seen) == 0)
+
+
+if __name__ == "__main__":
+    test_checkpoint_evaluator()
@@ -198,6 +198,32 @@ class GameAction:
     def get_trump(self):
         return self.trump
 
+class GameListener:
+    """
+    Receives the events of the games it is added to (see Game.add_listener)
+    """
+
+    def on_step(self, game, action, player):
+        # Called after game.step(action), action having been taken by player
+        pass
+
+    def on_game_end(self, game):
+        # Called after the on_step of the last card
+        pass
+
+    def on_redeal(self, game):
+        # Called when all players passed and the cards have been dealt again, before the on_step of the last pass
+        pass
+
+    def on_game_start(self, game):
+        # Called when a game is dealt (init_game) or restored from a position (set_state)
+        pass
+
+    def close(self):
+        # Called when the env using the game is closed
+        pass
+
+
 class Game:
 
     def __init__(self, seed=None):
@@ -206,6 +232,16 @@ class Game:
         self.deck = Deck().deck
         self.players = []
         self.rng = random
+        self.listeners = []
+        # Optional function with no arguments returning the next deal (see init_game), used when
+        # the cards are dealt again; if None, the deck is shuffled with self.rng
+        self.deal_source = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
 
     def seed(self, seed=None):
         if (seed is None):
@@ -213,9 +249,16 @@ class Game:
         else:
             self.rng = random.Random(seed)
 
-    def init_game(self):
+    def init_game(self, deal=None):
+        """
+        :param deal: optional sequence of 41 ints: the order of the 40 card indexes in the deck
+                     followed by the first player (see DealBank). If None, the deck is shuffled with self.rng
+        """
         self.deck = Deck().deck
-        self.rng.shuffle(self.deck)
+        if (deal is None):
+            self.rng.shuffle(self.deck)
+        else:
+            self.deck = [self.deck[i] for i in deal[:40]]
         self.players = []
         for i in range(self.np):
             p = Player(i)
@@ -225,7 +268,7 @@ class Game:
 
         # TODO: temp fix; not clear actually how the first_player should be set; maybe it should be passed from
         # whoever builds the environment
-        self.first_player = self.rng.randrange(0, self.np)
+        self.first_player = self.rng.randrange(0, self.np) if (deal is None) else int(deal[40])
         self.current_player = self.first_player
         self.tricks = []  # List of TrickInfo objects describing already completed tricks
         self.current_trick = []
@@ -241,6 +284,8 @@ class Game:
         self.highest_bidder = None
         self.game_points = [0 for i in range(self.np)]
         self.caller_won = None
+        for l in self.listeners:
+            l.on_game_start(self)
 
     def is_legal_card(self, card):
         hand = self.players[self.current_player].hand
@@ -297,10 +342,12 @@ class Game:
         if not self.is_legal_bid(bid):
             raise Exception("Player {0}: Illegal bid {1}".format(self.current_player, bid))
         self.update_bid_round(bid)
-        # Is bidding phase done? TODO: must consider the case where all players pass
+        # Is bidding phase done?
         actual_bids = list(filter(lambda b: b.type == BidType.RANK, self.bid_round))
         pass_bids = list(filter(lambda b: b.type == BidType.PASS, self.bid_round))
-        if (len(actual_bids) == 1 and len(pass_bids) == self.np - 1):
+        if (len(pass_bids) == self.np):
+            self.redeal()
+        elif (len(actual_bids) == 1 and len(pass_bids) == self.np - 1):
             # The bidding phase ends here, the trick phase begins
             self.caller = self.highest_bidder
             self.gamestate = GameState.CHOOSE_TRUMP
@@ -308,6 +355,12 @@ class Game:
         else:
             self.current_player = (self.current_player + 1) % self.np
 
+    def redeal(self):
+        # All players passed: the cards are dealt again and the bidding starts over
+        self.init_game(None if (self.deal_source is None) else self.deal_source())
+        for l in self.listeners:
+            l.on_redeal(self)
+
     #
     # Choose trump related functions
     #
@@ -385,12 +438,89 @@ class Game:
 
     # action comes from current_player
     def step(self, action):
+        player = self.current_player
         if (self.gamestate == GameState.BIDDING):
             self.step_bidding(action)
         elif (self.gamestate == GameState.CHOOSE_TRUMP):
             self.step_choose_trump(action)
         elif (self.gamestate == GameState.TRICK):
             self.step_trick(action)
+        for l in self.listeners:
+            l.on_step(self, action, player)
+        if (self.done):
+            for l in self.listeners:
+                l.on_game_end(self)
+
+    #
+    # Serialization related functions
+    #
+
+    def get_state(self):
+        """
+        :return: a JSON serializable dict with the whole state of the game (cards as indexes in the deck)
+        """
+        def card_index(c):
+            return None if (c is None) else Deck.get_index_from_card(c)
+
+        def bid_state(b):
+            return [b.type.name, None if (b.rank is None) else b.rank.rank]
+
+        return {
+            'hands': [[card_index(c) for c in p.hand] for p in self.players],
+            'points': [p.points for p in self.players],
+            'first_player': self.first_player,
+            'current_player': self.current_player,
+            'tricks': [[[card_index(c) for c in t.cards], t.first_player, t.winner, t.points] for t in self.tricks],
+            'current_trick': [card_index(c) for c in self.current_trick],
+            'n_trick': self.n_trick,
+            'done': self.done,
+            'gamestate': int(self.gamestate),
+            'bid_round': [bid_state(b) for b in self.bid_round],
+            'highest_bid': bid_state(self.highest_bid),
+            'highest_bidder': self.highest_bidder,
+            'caller': self.caller,
+            'partner': self.partner,
+            'trump': None if (self.trump is None) else Deck.suits.index(self.trump),
+            'partner_card': card_index(self.partner_card),
+            'game_points': list(self.game_points),
+            'caller_won': self.caller_won
+        }
+
+    def set_state(self, state):
+        """
+        Restores a state returned by get_state
+        """
+        def card(i):
+            return None if (i is None) else Deck.get_card_from_index(i)
+
+        def bid(b):
+            return Bid(BidType[b[0]], None if (b[1] is None) else Deck.get_rank_from_index(b[1]))
+
+        self.deck = Deck().deck
+        self.players = []
+        for i in range(self.np):
+            p = Player(i)
+            p.hand = [card(c) for c in state['hands'][i]]
+            p.points = state['points'][i]
+            self.players.append(p)
+        self.first_player = state['first_player']
+        self.current_player = state['current_player']
+        self.tricks = [TrickInfo([card(c) for c in t[0]], t[1], t[2], t[3]) for t in state['tricks']]
+        self.current_trick = [card(c) for c in state['current_trick']]
+        self.n_trick = state['n_trick']
+        self.done = state['done']
+        self.gamestate = GameState(state['gamestate'])
+        self.bid_round = [bid(b) for b in state['bid_round']]
+        self.highest_bid = bid(state['highest_bid'])
+        self.highest_bidder = state['highest_bidder']
+        self.caller = state['caller']
+        self.partner = state['partner']
+        self.trump = None if (state['trump'] is None) else Deck.get_suit_from_index(state['trump'])
+        self.partner_card = card(state['partner_card'])
+        self.game_points = list(state['game_points'])
+        self.caller_won = state['caller_won']
+        for l in self.listeners:
+            l.on_game_start(self)
 
 
 #
@@ -464,6 +594,48 @@ def test_winning_card():
     assert (win == 4 and points == 29)
 
 
+def test_state_roundtrip():
+    import json
+
+    game = Game()
+    game.seed(7)
+    game.init_game()
+    game.step(GameAction(GameState.BIDDING, Bid(BidType.RANK, Deck.ranks[4])))
+    for i in range(game.np - 1):
+        game.step(GameAction(GameState.BIDDING, Bid(BidType.PASS)))
+    game.step(GameAction(GameState.CHOOSE_TRUMP, Deck.suits[1]))
+    for i in range(7):
+        game.step(GameAction(GameState.TRICK, game.get_player_hand(game.current_player)[0]))
+
+    state = json.loads(json.dumps(game.get_state()))
+    restored = Game()
+    restored.set_state(state)
+    assert (restored.get_state() == game.get_state())
+    assert (restored.gamestate == GameState.TRICK and restored.trump == Deck.suits[1])
+
+
+def test_redeal():
+    class Redeals(GameListener):
+        n = 0
+
+        def on_redeal(self, game):
+            self.n += 1
+
+    deal = list(range(40)) + [2]
+    game = Game()
+    game.deal_source = lambda: deal
+    listener = Redeals()
+    game.add_listener(listener)
+    game.seed(5)
+    game.init_game()
+    for i in range(game.np):
+        game.step(GameAction(GameState.BIDDING, Bid(BidType.PASS)))
+    assert (listener.n == 1 and game.gamestate == GameState.BIDDING and game.first_player == 2)
+    assert ([Deck.get_index_from_card(c) for c in game.players[0].hand] == list(range(7, -1, -1)))
+
+
 if __name__ == "__main__":
     # test_shuffle()
     test_winning_card()
+    test_state_roundtrip()
+    test_redeal()
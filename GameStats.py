@@ -0,0 +1,253 @@
+#
+# Streaming statistics of the games played.
+#
+# GameStats is a GameListener aggregating, with O(1) work per event, fixed-size histograms
+# of the outcome of each game (winning bid, solo games, trick in which the partner is
+# revealed, caller vs. defender points, trump suit) and a ring buffer with the last games.
+# Collectors of different workers are merged by summing their arrays, and each collector
+# can periodically export a snapshot to a JSON file, to watch the metrics live.
+#
+import json
+import os
+import time
+
+import numpy as np
+
+from Game import Deck, GameListener
+
+N_RANKS = len(Deck.ranks)
+N_SUITS = len(Deck.suits)
+N_TRICKS = 8
+TOTAL_POINTS = 120
+
+# Columns of the ring buffer of the last games
+RECENT_FIELDS = ('winning_bid', 'solo', 'reveal_trick', 'caller_points', 'trump', 'caller_won')
+# Bins of reveal_trick after the tricks: solo games, and games whose partner was revealed
+# before they were tracked (e.g. started from a stored position)
+NOT_REVEALED = N_TRICKS
+REVEAL_UNKNOWN = N_TRICKS + 1
+
+
+class GameStats(GameListener):
+    """
+    :param recent: size of the ring buffer of the last games
+    :param export_path: optional JSON file where a snapshot is written every export_interval seconds
+    """
+
+    def __init__(self, recent=10000, export_path=None, export_interval=30.0):
+        self.games = 0
+        self.caller_wins = 0
+        self.solo_games = 0
+        self.winning_bid = np.zeros(N_RANKS, dtype=np.int64)
+        # Trick (0..7) in which the partner card was played, then the NOT_REVEALED bin (solo games,
+        # where the caller holds the partner card) and the REVEAL_UNKNOWN one
+        self.reveal_trick = np.zeros(N_TRICKS + 2, dtype=np.int64)
+        self.caller_points = np.zeros(TOTAL_POINTS + 1, dtype=np.int64)
+        self.trump = np.zeros(N_SUITS, dtype=np.int64)
+        self.recent = np.zeros((recent, len(RECENT_FIELDS)), dtype=np.int16)
+        self.recent_next = 0
+        self.recent_count = 0
+        self.export_path = export_path
+        self.export_interval = export_interval
+        self.last_export = time.time()
+        self._reveal = {}
+
+    #
+    # GameListener
+    #
+
+    def on_game_start(self, game):
+        # None until the partner is revealed
+        self._reveal[id(game)] = None if (game.partner is None) else REVEAL_UNKNOWN
+
+    def on_step(self, game, action, player):
+        key = id(game)
+        if (game.partner is not None and self._reveal.get(key, REVEAL_UNKNOWN) is None):
+            # The step which has just completed a trick leaves the current trick empty
+            self._reveal[key] = game.n_trick - (1 if (len(game.current_trick) == 0) else 0)
+
+    def on_game_end(self, game):
+        reveal = self._reveal.pop(id(game), None)
+        if (reveal is None):
+            # Listener added in the middle of the game
+            reveal = REVEAL_UNKNOWN
+        solo = game.caller == game.partner
+        caller_points = game.players[game.caller].points
+        if (not solo):
+            caller_points += game.players[game.partner].points
+        self.add(game.highest_bid.rank.rank, solo, NOT_REVEALED if (solo) else reveal, caller_points,
+                 Deck.suits.index(game.trump), game.caller_won)
+
+    def add(self, winning_bid, solo, reveal_trick, caller_points, trump, caller_won):
+        self.games += 1
+        self.caller_wins += int(caller_won)
+        self.solo_games += int(solo)
+        self.winning_bid[winning_bid] += 1
+        self.reveal_trick[reveal_trick] += 1
+        self.caller_points[caller_points] += 1
+        self.trump[trump] += 1
+        self.recent[self.recent_next] = (winning_bid, solo, reveal_trick, caller_points, trump, caller_won)
+        self.recent_next = (self.recent_next + 1) % len(self.recent)
+        self.recent_count = min(self.recent_count + 1, len(self.recent))
+        if (self.export_path is not None and time.time() - self.last_export > self.export_interval):
+            self.export()
+
+    #
+    # Merge and export
+    #
+
+    def recent_games(self):
+        """
+        :return: the rows of the ring buffer, oldest first
+        """
+        if (self.recent_count < len(self.recent)):
+            return self.recent[:self.recent_count]
+        return np.roll(self.recent, -self.recent_next, axis=0)
+
+    def merge(self, other):
+        """
+        Adds the statistics of other (e.g. the collector of another worker) to these
+        """
+        self.games += other.games
+        self.caller_wins += other.caller_wins
+        self.solo_games += other.solo_games
+        self.winning_bid += other.winning_bid
+        self.reveal_trick += other.reveal_trick
+        self.caller_points += other.caller_points
+        self.trump += other.trump
+        rows = np.concatenate([self.recent_games(), other.recent_games()])[-len(self.recent):]
+        self.recent[:len(rows)] = rows
+        self.recent_count = len(rows)
+        self.recent_next = len(rows) % len(self.recent)
+        return self
+
+    def to_dict(self):
+        return {
+            'games': self.games,
+            'caller_wins': self.caller_wins,
+            'solo_games': self.solo_games,
+            'winning_bid': self.winning_bid.tolist(),
+            'reveal_trick': self.reveal_trick.tolist(),
+            'caller_points': self.caller_points.tolist(),
+            'trump': self.trump.tolist(),
+            'recent': self.recent_games().tolist()
+        }
+
+    @staticmethod
+    def from_dict(d, recent=10000):
+        s = GameStats(recent)
+        s.games = d['games']
+        s.caller_wins = d['caller_wins']
+        s.solo_games = d['solo_games']
+        for k in ('winning_bid', 'reveal_trick', 'caller_points', 'trump'):
+            getattr(s, k)[:len(d[k])] = d[k]
+        rows = np.array(d['recent'], dtype=np.int16).reshape(-1, len(RECENT_FIELDS))[-recent:]
+        s.recent[:len(rows)] = rows
+        s.recent_count = len(rows)
+        s.recent_next = len(rows) % recent
+        return s
+
+    def summary(self):
+        """
+        :return: dict of scalar metrics, e.g. for the training loggers
+        """
+        n = max(self.games, 1)
+        points = np.arange(TOTAL_POINTS + 1)
+        revealed = self.reveal_trick[:N_TRICKS]
+        return {
+            'games': self.games,
+            'caller_win_rate': self.caller_wins / n,
+            'solo_rate': self.solo_games / n,
+            'mean_winning_bid': float(self.winning_bid @ np.arange(N_RANKS)) / n,
+            'mean_caller_points': float(self.caller_points @ points) / n,
+            'mean_defender_points': float(self.caller_points @ (TOTAL_POINTS - points)) / n,
+            'mean_reveal_trick': float(revealed @ np.arange(N_TRICKS)) / max(int(revealed.sum()), 1),
+            'trump_share': (self.trump / n).tolist()
+        }
+
+    def export(self, path=None):
+        path = self.export_path if (path is None) else path
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({'time': time.time(), 'summary': self.summary(), 'stats': self.to_dict()}, f)
+        os.replace(tmp, path)
+        self.last_export = time.time()
+
+    def close(self):
+        # Flushes the statistics collected since the last periodic export
+        if (self.export_path is not None):
+            self.export()
+
+
+def merge_exports(paths, recent=10000):
+    """
+    :return: a GameStats with the statistics of the snapshots exported by several collectors
+    """
+    total = GameStats(recent)
+    for path in paths:
+        with open(path) as f:
+            total.merge(GameStats.from_dict(json.load(f)['stats'], recent))
+    return total
+
+
+#
+# TESTS
+#
+
+def test_game_stats():
+    import random
+    from Game import Game, GameAction, GameState, Bid, BidType
+
+    stats = GameStats(recent=4)
+    rng = random.Random(0)
+    for g in range(10):
+        game = Game()
+        game.add_listener(stats)
+        game.seed(g)
+        game.init_game()
+        game.step(GameAction(GameState.BIDDING, Bid(BidType.RANK, Deck.ranks[rng.randrange(10)])))
+        for i in range(game.np - 1):
+            game.step(GameAction(GameState.BIDDING, Bid(BidType.PASS)))
+        game.step(GameAction(GameState.CHOOSE_TRUMP, Deck.suits[rng.randrange(4)]))
+        while (not game.done):
+            hand = game.get_player_hand(game.current_player)
+            game.step(GameAction(GameState.TRICK, hand[rng.randrange(len(hand))]))
+
+    assert (stats.games == 10 and stats.trump.sum() == 10 and stats.reveal_trick.sum() == 10)
+    assert (len(stats.recent_games()) == 4)
+    merged = GameStats.from_dict(json.loads(json.dumps(stats.to_dict())), recent=4).merge(stats)
+    assert (merged.games == 20 and np.array_equal(merged.caller_points, 2 * stats.caller_points))
+    s = stats.summary()
+    assert (abs(s['mean_caller_points'] + s['mean_defender_points'] - TOTAL_POINTS) < 1e-9)
+
+    # A game restored after the partner was revealed is not counted as solo
+    import os
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "stats.json")
+    stats = GameStats(export_path=path, export_interval=3600)
+    while True:
+        game.seed(rng.randrange(1000))
+        game.init_game()
+        game.step(GameAction(GameState.BIDDING, Bid(BidType.RANK, Deck.ranks[9])))
+        for i in range(game.np - 1):
+            game.step(GameAction(GameState.BIDDING, Bid(BidType.PASS)))
+        game.step(GameAction(GameState.CHOOSE_TRUMP, Deck.suits[0]))
+        while (game.partner is None and not game.done):
+            game.step(GameAction(GameState.TRICK, game.get_player_hand(game.current_player)[0]))
+        if (game.partner is not None and game.partner != game.caller and not game.done):
+            break
+    restored = Game()
+    restored.add_listener(stats)
+    restored.set_state(game.get_state())
+    while (not restored.done):
+        restored.step(GameAction(GameState.TRICK, restored.get_player_hand(restored.current_player)[0]))
+    assert (stats.reveal_trick[REVEAL_UNKNOWN] == 1 and stats.solo_games == 0)
+
+    # close() flushes what the periodic export has not written yet
+    stats.close()
+    with open(path) as f:
+        assert (json.load(f)['stats']['games'] == 1)
+
+
+if __name__ == "__main__":
+    test_game_stats()
@@ -0,0 +1,231 @@
+#
+# Core game kernels over integer card ids, optionally JIT compiled.
+#
+# Cards are ids 0..39 (suit * 10 + rank, as Deck.get_index_from_card), suits 0..3.
+# If numba is installed the kernels are compiled with numba.njit, otherwise the very
+# same functions run as plain Python. The random playouts use their own integer
+# generator, so the results are bit-identical between the two backends.
+#
+import os
+
+import numpy as np
+
+from Game import Deck, Rules
+
+try:
+    if (os.environ.get("BRISCOLA_NO_JIT")):
+        raise ImportError("JIT disabled by BRISCOLA_NO_JIT")
+    import numba
+    BACKEND = "numba"
+
+    def jit(f):
+        return numba.njit(cache=True, nogil=True)(f)
+except ImportError:
+    BACKEND = "python"
+
+    def jit(f):
+        return f
+
+N_PLAYERS = Rules.NUM_PLAYERS
+N_RANKS = len(Deck.ranks)
+N_CARDS = N_RANKS * len(Deck.suits)
+HAND_SIZE = N_CARDS // N_PLAYERS
+RANK_POINTS = np.array([r.points for r in Deck.ranks], dtype=np.int64)
+
+
+@jit
+def lcg_next(state):
+    # 31-bit linear congruential generator: products stay well within int64
+    return (state * 1103515245 + 12345) & 0x7FFFFFFF
+
+
+@jit
+def lcg_choice(state, n):
+    # The low bits of a power-of-two LCG have short periods (bit 0 just alternates): draw from the high ones
+    return (state >> 16) % n
+
+
+@jit
+def trick_winner(cards, trump, rank_points):
+    """
+    :param cards: the N_PLAYERS card ids of a trick, in the order in which they were played
+    :return: (position of the winning card in the trick, total points in the trick)
+    """
+    win = 0
+    points = rank_points[cards[0] % 10]
+    for i in range(1, len(cards)):
+        c = cards[i]
+        w = cards[win]
+        cs = c // 10
+        ws = w // 10
+        if ((cs == trump and ws != trump) or (cs == ws and c % 10 > w % 10)):
+            win = i
+        points += rank_points[c % 10]
+    return win, points
+
+
+@jit
+def legal_mask(hand, count):
+    """
+    :param hand: card ids in hand (only the first count are valid)
+    :return: (N_CARDS,) bool mask of the cards that can be played
+    """
+    mask = np.zeros(N_CARDS, dtype=np.bool_)
+    for i in range(count):
+        mask[hand[i]] = True
+    return mask
+
+
+@jit
+def random_playout(hands, counts, trick, trick_len, first_player, n_trick, trump, partner_card,
+                   caller, partner, points, rank_points, seed):
+    """
+    Plays the trick phase of a game to the end with uniformly random cards.
+    :param hands: (N_PLAYERS, HAND_SIZE) card ids in hand, counts: number of cards of each player
+    :param trick: (N_PLAYERS,) cards of the current trick, trick_len of them played so far
+    :param partner: seat of the partner, -1 if not revealed yet
+    :param points: (N_PLAYERS,) points taken so far
+    :return: (N_PLAYERS,) game points, as Game.game_points
+    """
+    n = hands.shape[0]
+    hands = hands.copy()
+    counts = counts.copy()
+    trick = trick.copy()
+    points = points.copy()
+    state = seed & 0x7FFFFFFF
+    while (n_trick < HAND_SIZE):
+        player = (first_player + trick_len) % n
+        state = lcg_next(state)
+        i = lcg_choice(state, counts[player])
+        card = hands[player, i]
+        # Remove the card keeping the order of the others
+        for j in range(i, counts[player] - 1):
+            hands[player, j] = hands[player, j + 1]
+        counts[player] -= 1
+        trick[trick_len] = card
+        trick_len += 1
+        if (card == partner_card):
+            partner = player
+        if (trick_len == n):
+            win, p = trick_winner(trick, trump, rank_points)
+            first_player = (first_player + win) % n
+            points[first_player] += p
+            trick_len = 0
+            n_trick += 1
+
+    caller_points = points[caller]
+    if (partner != caller):
+        caller_points += points[partner]
+    caller_won = caller_points > 120 - caller_points
+    game_points = np.zeros(n, dtype=np.int64)
+    for p in range(n):
+        if (p == caller):
+            game_points[p] = 4 if (partner == caller) else 2
+        elif (p == partner):
+            game_points[p] = 1
+        else:
+            game_points[p] = -1
+        if (not caller_won):
+            game_points[p] = -game_points[p]
+    return game_points
+
+
+def compact_state(game):
+    """
+    :return: dict with the arrays of the trick phase state of a Game, as taken by random_playout
+    """
+    hands = np.zeros((game.np, HAND_SIZE), dtype=np.int64)
+    counts = np.zeros(game.np, dtype=np.int64)
+    for i, p in enumerate(game.players):
+        for j, c in enumerate(p.hand):
+            hands[i, j] = Deck.get_index_from_card(c)
+        counts[i] = len(p.hand)
+    trick = np.zeros(game.np, dtype=np.int64)
+    for j, c in enumerate(game.current_trick):
+        trick[j] = Deck.get_index_from_card(c)
+    return {
+        'hands': hands,
+        'counts': counts,
+        'trick': trick,
+        'trick_len': len(game.current_trick),
+        'first_player': game.first_player,
+        'n_trick': game.n_trick,
+        'trump': Deck.suits.index(game.trump),
+        'partner_card': Deck.get_index_from_card(game.partner_card),
+        'caller': game.caller,
+        'partner': -1 if (game.partner is None) else game.partner,
+        'points': np.array([p.points for p in game.players], dtype=np.int64)
+    }
+
+
+def playout(game, seed, kernel=random_playout):
+    """
+    Random playout of a Game in the trick phase
+    :return: the final game points of each player
+    """
+    s = compact_state(game)
+    return kernel(s['hands'], s['counts'], s['trick'], s['trick_len'], s['first_player'], s['n_trick'],
+                  s['trump'], s['partner_card'], s['caller'], s['partner'], s['points'], RANK_POINTS, seed)
+
+
+def python_kernel(f):
+    """
+    :return: the pure Python version of a kernel, whatever the backend
+    """
+    return getattr(f, "py_func", f)
+
+
+#
+# TESTS
+#
+
+def test_kernels():
+    import random
+    from Game import Game, GameAction, GameState, Bid, BidType
+
+    rng = random.Random(0)
+    rules = Rules()
+    for i in range(200):
+        ids = np.array(rng.sample(range(N_CARDS), N_PLAYERS), dtype=np.int64)
+        trump = rng.randrange(4)
+        expected = rules.winning_card([Deck.get_card_from_index(c) for c in ids], Deck.suits[trump])
+        assert (tuple(int(x) for x in trick_winner(ids, trump, RANK_POINTS)) == expected)
+        assert (tuple(python_kernel(trick_winner)(ids, trump, RANK_POINTS)) == expected)
+
+    game = Game()
+    game.seed(3)
+    game.init_game()
+    game.step(GameAction(GameState.BIDDING, Bid(BidType.RANK, Deck.ranks[9])))
+    for i in range(game.np - 1):
+        game.step(GameAction(GameState.BIDDING, Bid(BidType.PASS)))
+    game.step(GameAction(GameState.CHOOSE_TRUMP, Deck.suits[0]))
+    for i in range(12):
+        game.step(GameAction(GameState.TRICK, game.get_player_hand(game.current_player)[-1]))
+    for seed in range(50):
+        jitted = playout(game, seed)
+        assert (np.array_equal(jitted, playout(game, seed, python_kernel(random_playout))))
+        assert (sorted(jitted.tolist()) in ([-4, 1, 1, 1, 1], [-1, -1, -1, -1, 4], [-2, -1, 1, 1, 1],
+                                            [-1, -1, -1, 1, 2]))
+
+    # Successive draws are uniform and independent, for every hand size
+    for n in range(2, HAND_SIZE + 1):
+        state = n
+        draws = np.zeros(20000, dtype=np.int64)
+        for k in range(len(draws)):
+            state = lcg_next(state)
+            draws[k] = lcg_choice(state, n)
+        expected = len(draws) / n
+        assert (np.all(np.abs(np.bincount(draws, minlength=n) - expected) < 0.1 * expected))
+        pairs = np.bincount(draws[:-1] * n + draws[1:], minlength=n * n)
+        assert (np.all(np.abs(pairs - expected / n) < 0.25 * expected / n))
+
+    # A playout from the state before the last card agrees with Game
+    while (not (game.n_trick == 7 and len(game.current_trick) == game.np - 1)):
+        game.step(GameAction(GameState.TRICK, game.get_player_hand(game.current_player)[0]))
+    points = playout(game, 0)
+    game.step(GameAction(GameState.TRICK, game.get_player_hand(game.current_player)[0]))
+    assert (points.tolist() == game.game_points)
+
+
+if __name__ == "__main__":
+    test_kernels()
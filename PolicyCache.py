@@ -0,0 +1,335 @@
+#
+# Cache in front of policy inference.
+#
+# The same information states recur in evaluation and search (same opening hands
+# under rotated seats, same late-trick positions, repeated seeds): instead of running
+# a forward pass through the model each time, the policy output is cached with
+# an LRU policy, keyed by an incrementally maintained hash of the information state
+# of the observing player, optionally up to a relabelling of the suits.
+#
+import os
+import pickle
+import random
+import time
+from collections import OrderedDict
+
+from Game import Deck, BidType, GameListener, Rules
+from Symmetry import SuitPermutation
+
+N_SUITS = len(Deck.suits)
+N_RANKS = len(Deck.ranks)
+N_TRICKS = 8
+BID_VALUES = len(Deck.ranks) + 1  # ranks + pass
+
+
+class InfoStateHasher(GameListener):
+    """
+    Zobrist hashing of the information state of each player, maintained as a listener of the game.
+    The hash of a player is the xor of the keys of the cards in its hand and of all the
+    public events (bids, trump, cards played) seen so far. Seats are taken relative to the
+    observing player, so that the same situation under rotated seats has the same hash.
+    Keys do not depend on the suits: the events of each suit are xored in a hash of their own,
+    and the suit hashes are combined either in suit order (hash) or sorted (canonical), so that
+    states differing only by a relabelling of the suits (see Symmetry) share the canonical hash.
+    Each event costs a few xors, independently of the length of the game.
+    Positions restored with Game.set_state are hashed from what the state keeps: the last bid of each player.
+    """
+    MAX_BIDS = 64
+    MASK = (1 << 64) - 1
+
+    def __init__(self, seed=0):
+        self.np = Rules.NUM_PLAYERS
+        rng = random.Random(seed)
+
+        def keys(n):
+            return [rng.getrandbits(64) for i in range(n)]
+
+        self.hand_keys = keys(N_RANKS)
+        self.first_player_keys = keys(self.np)
+        self.bid_keys = keys(self.MAX_BIDS * self.np * BID_VALUES)
+        self.trump_key = rng.getrandbits(64)
+        self.played_keys = keys(N_RANKS * N_TRICKS * self.np * self.np)
+        # Odd multipliers mixing each suit hash with its position, before they are combined
+        self.suit_mix = [rng.getrandbits(64) | 1 for i in range(N_SUITS)]
+        self.base = [0] * self.np
+        self.suit_hashes = [[0] * N_SUITS for p in range(self.np)]
+        self.n_bids = 0
+
+    def reset(self, game):
+        """
+        Computes the hashes of the current state of game
+        """
+        self.n_bids = 0
+        deal_first_player = game.tricks[0].first_player if (game.tricks) else game.first_player
+        for p in range(self.np):
+            self.base[p] = self.first_player_keys[(deal_first_player - p) % self.np]
+            self.suit_hashes[p] = [0] * N_SUITS
+            for c in game.get_player_hand(p):
+                self.suit_hashes[p][Deck.suits.index(c.suit)] ^= self.hand_keys[c.card_rank()]
+        for player, bid in enumerate(game.bid_round):
+            if (bid.type != BidType.NONE):
+                self._bid(player, bid)
+        if (game.trump is not None):
+            self._trump(game.trump)
+        for t, trick in enumerate(game.tricks):
+            for pos, c in enumerate(trick.cards):
+                self._played((trick.first_player + pos) % self.np, c, t, pos)
+        for pos, c in enumerate(game.current_trick):
+            self._played((game.first_player + pos) % self.np, c, game.n_trick, pos)
+
+    def _bid(self, player, bid):
+        value = len(Deck.ranks) if (bid.type == BidType.PASS) else bid.rank.rank
+        if (self.n_bids >= self.MAX_BIDS):
+            raise Exception("Too many bids: {0}".format(self.n_bids))
+        for p in range(self.np):
+            rel = (player - p) % self.np
+            self.base[p] ^= self.bid_keys[(self.n_bids * self.np + rel) * BID_VALUES + value]
+        self.n_bids += 1
+
+    def _trump(self, suit):
+        si = Deck.suits.index(suit)
+        for p in range(self.np):
+            self.suit_hashes[p][si] ^= self.trump_key
+
+    def _played(self, player, card, n_trick, pos):
+        si = Deck.suits.index(card.suit)
+        for p in range(self.np):
+            rel = (player - p) % self.np
+            self.suit_hashes[p][si] ^= self.played_keys[((card.card_rank() * N_TRICKS + n_trick) * self.np + pos)
+                                                        * self.np + rel]
+
+    #
+    # GameListener
+    #
+
+    def on_game_start(self, game):
+        # Also called when the cards are dealt again
+        self.reset(game)
+
+    def on_step(self, game, action, player):
+        if (hasattr(action, 'bid')):
+            if (all(b.type == BidType.NONE for b in game.bid_round)):
+                # Last pass before the cards were dealt again: the hashes are already those of the new deal
+                return
+            self._bid(player, action.get_bid())
+        elif (hasattr(action, 'trump')):
+            self._trump(action.get_trump())
+        else:
+            # The step which has just completed a trick leaves the current trick empty
+            completed = len(game.current_trick) == 0
+            card = action.get_card()
+            self._played(player, card, game.n_trick - 1 if (completed) else game.n_trick,
+                         self.np - 1 if (completed) else len(game.current_trick) - 1)
+            # The card leaves the hand of the player who played it
+            self.suit_hashes[player][Deck.suits.index(card.suit)] ^= self.hand_keys[card.card_rank()]
+
+    def _combine(self, player, order):
+        h = self.base[player]
+        for i, si in enumerate(order):
+            h ^= (self.suit_hashes[player][si] * self.suit_mix[i]) & self.MASK
+        return h
+
+    def hash(self, player):
+        return self._combine(player, range(N_SUITS))
+
+    def canonical(self, player):
+        """
+        :return: (hash, SuitPermutation): the hash of the information state of player up to a relabelling
+                 of the suits, and the permutation mapping the state to the canonical labelling
+        """
+        order = sorted(range(N_SUITS), key=lambda si: self.suit_hashes[player][si])
+        perm = [0] * N_SUITS
+        for i, si in enumerate(order):
+            perm[si] = i
+        return self._combine(player, order), SuitPermutation(perm)
+
+
+class PolicyCache:
+    """
+    Bounded size LRU cache of policy outputs, optionally persisted on disk between runs.
+    :param model_id: identifier of the model whose outputs are cached (e.g. the checkpoint path);
+                     it is saved with the entries, and entries saved for a different model are discarded on load
+    """
+
+    def __init__(self, maxsize=100000, path=None, model_id=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.model_id = model_id
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.hit_time = 0.0
+        self.miss_time = 0.0
+        if (path is not None and os.path.exists(path)):
+            self.load(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, compute):
+        """
+        :param key: hash of the information state
+        :param compute: function with no arguments computing the policy output on a miss
+        :return: the (possibly cached) policy output
+        """
+        start = time.perf_counter()
+        try:
+            value = self.entries[key]
+        except KeyError:
+            value = compute()
+            self.put(key, value)
+            self.misses += 1
+            self.miss_time += time.perf_counter() - start
+            return value
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.hit_time += time.perf_counter() - start
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while (len(self.entries) > self.maxsize):
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if (lookups > 0) else 0.0,
+            'mean_hit_latency': self.hit_time / self.hits if (self.hits > 0) else 0.0,
+            'mean_miss_latency': self.miss_time / self.misses if (self.misses > 0) else 0.0,
+        }
+
+    def save(self, path=None):
+        path = self.path if (path is None) else path
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump({'model_id': self.model_id, 'entries': list(self.entries.items())}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def load(self, path):
+        """
+        :return: the number of entries loaded: 0 if the file was saved for a different model_id
+        """
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if (not isinstance(data, dict) or data.get('model_id') != self.model_id):
+            # Outputs of other weights (or of an unknown model) would be stale
+            return 0
+        for k, v in data['entries']:
+            self.put(k, v)
+        return len(data['entries'])
+
+
+class CachedPolicy:
+    """
+    Wraps a function computing the policy output for an observation (e.g. the action logits
+    of ParametricActionsModel) with a PolicyCache.
+    """
+
+    def __init__(self, policy_fn, cache=None):
+        self.policy_fn = policy_fn
+        self.cache = PolicyCache() if (cache is None) else cache
+
+    def __call__(self, key, obs):
+        return self.cache.get(key, lambda: self.policy_fn(obs))
+
+    def canonical(self, hasher, player, obs):
+        """
+        Looks up the output for the canonical labelling of the suits, shared by all the symmetric states.
+        The policy output must be the flat action logits (see SuitPermutation.real_logits).
+        :param hasher: the InfoStateHasher listening to the game of obs
+        :return: the logits for the real labelling of the suits
+        """
+        key, perm = hasher.canonical(player)
+        return perm.real_logits(self.cache.get(key, lambda: self.policy_fn(perm.observation(obs))))
+
+
+def trainer_policy_fn(trainer, policy_id="default_policy"):
+    """
+    :return: a function computing the action distribution inputs (logits) of an rllib trainer
+    """
+    def policy_fn(obs):
+        _, _, info = trainer.compute_single_action(obs, policy_id=policy_id, explore=False, full_fetch=True)
+        return info['action_dist_inputs']
+    return policy_fn
+
+
+#
+# TESTS
+#
+
+def test_info_state_hasher():
+    import numpy as np
+    from BriscolaChiamata import BriscolaChiamataEnv
+    from RandomAgent import RandomAgent
+    from Symmetry import symmetric_permutations
+
+    def play(seed, relabel=None):
+        env = BriscolaChiamataEnv()
+        hasher = InfoStateHasher()
+        env.game.add_listener(hasher)
+        env.seed(seed)
+        env.reset()
+        if (relabel is not None):
+            for pl in env.game.players:
+                pl.hand = [Deck.get_card_from_index(relabel.card(Deck.get_index_from_card(c))) for c in pl.hand]
+            hasher.reset(env.game)
+        np.random.seed(seed)
+        agents = [RandomAgent(i) for i in range(env.game.np)]
+        hashes = []
+        canonical = []
+        while (not env.game.done):
+            p = env.game.current_player
+            obs = env.observe(env.agents[p])
+            key, perm = hasher.canonical(p)
+            hashes.append(hasher.hash(p))
+            canonical.append((key, perm.observation(obs)['observation']['player_hand'].tobytes()))
+            # The same random choices, in the relabelled space
+            action = agents[p].act(obs if (relabel is None) else relabel.inverted().observation(obs))
+            env.step(action if (relabel is None) else relabel.action(action))
+        return hashes, canonical
+
+    hashes, canonical = play(3)
+    # Each decision point of a game is a different information state
+    assert (len(set(hashes)) == len(hashes))
+    # A relabelling of the suits changes the hashes, but not the canonical ones
+    for q in symmetric_permutations()[1:4]:
+        h, c = play(3, q)
+        assert (c == canonical and h != hashes)
+
+    # Canonical logits map back to the real suits
+    perm = SuitPermutation([2, 0, 3, 1])
+    logits = np.arange(BID_VALUES + N_SUITS + N_SUITS * N_RANKS, dtype=np.float64)
+    assert (np.array_equal(perm.real_logits(perm.logits(logits)), logits))
+
+    cache = PolicyCache(maxsize=2)
+    cache.get(1, lambda: 'a')
+    cache.get(2, lambda: 'b')
+    assert (cache.get(1, lambda: 'x') == 'a')
+    cache.get(3, lambda: 'c')
+    assert (2 not in cache and 1 in cache)
+    assert (cache.stats()['hits'] == 1)
+
+    # Persisted entries are only reused by the same model
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "cache.pkl")
+    saved = PolicyCache(path=path, model_id="checkpoint_1")
+    saved.put(1, 'a')
+    saved.save()
+    assert (PolicyCache(path=path, model_id="checkpoint_1").get(1, lambda: 'x') == 'a')
+    assert (PolicyCache(path=path, model_id="checkpoint_2").get(1, lambda: 'x') == 'x')
+
+
+if __name__ == "__main__":
+    test_info_state_hasher()
@@ -0,0 +1,130 @@
+#
+# Bank of stored game positions to reset the env from.
+#
+# Late-trick decisions, where most of the points are decided, are rare when every
+# episode starts from the bidding phase. A PositionBank stores serialized Game
+# positions (see Game.get_state) and samples them with configurable weights, so that
+# BriscolaChiamataEnv.reset can start from the phases we want to train on.
+#
+import bisect
+import json
+import random
+
+from Game import GameState
+
+
+def phase_of(position):
+    """
+    :return: the phase of a position: 'bidding', 'choose_trump' or 'trick_<n>' (n = number of completed tricks)
+    """
+    state = GameState(position['gamestate'])
+    if (state == GameState.BIDDING):
+        return 'bidding'
+    elif (state == GameState.CHOOSE_TRUMP):
+        return 'choose_trump'
+    else:
+        return 'trick_{0}'.format(position['n_trick'])
+
+
+class PositionBank:
+    """
+    :param phase_weights: dict phase -> weight of the positions of that phase (see phase_of);
+                          phases not in the dict have weight default_weight
+    """
+
+    def __init__(self, positions=None, phase_weights=None, default_weight=1.0):
+        self.phase_weights = {} if (phase_weights is None) else dict(phase_weights)
+        self.default_weight = default_weight
+        self.positions = []
+        self.cum_weights = []
+        for p in ([] if (positions is None) else positions):
+            self.add(p)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def weight(self, position):
+        return self.phase_weights.get(phase_of(position), self.default_weight)
+
+    def add(self, position):
+        total = self.cum_weights[-1] if (self.cum_weights) else 0.0
+        self.positions.append(position)
+        self.cum_weights.append(total + self.weight(position))
+
+    def set_phase_weights(self, phase_weights):
+        self.phase_weights = dict(phase_weights)
+        positions = self.positions
+        self.positions = []
+        self.cum_weights = []
+        for p in positions:
+            self.add(p)
+
+    def sample(self, rng=random):
+        """
+        :param rng: random.Random (or the random module) used to draw the position
+        :return: a position, drawn with probability proportional to its weight
+        """
+        if (len(self.positions) == 0 or self.cum_weights[-1] <= 0):
+            raise Exception("PositionBank: no position with positive weight")
+        x = rng.random() * self.cum_weights[-1]
+        return self.positions[bisect.bisect_right(self.cum_weights, x)]
+
+    def save(self, path):
+        with open(path, "w") as f:
+            for p in self.positions:
+                f.write(json.dumps(p) + "\n")
+
+    @staticmethod
+    def load(path, phase_weights=None, default_weight=1.0):
+        with open(path) as f:
+            positions = [json.loads(line) for line in f if line.strip()]
+        return PositionBank(positions, phase_weights, default_weight)
+
+
+def collect_positions(env, agents, n_games, keep=None):
+    """
+    Plays n_games in env and collects the positions at each decision point.
+    :param env: a BriscolaChiamataEnv
+    :param agents: list of agents, one per player, with an act(obs) method
+    :param keep: optional function game -> bool selecting which positions are kept
+    :return: list of positions
+    """
+    positions = []
+    for i in range(n_games):
+        env.reset()
+        for a in agents:
+            a.reset()
+        while (not env.game.done):
+            if (keep is None or keep(env.game)):
+                positions.append(env.game.get_state())
+            p = env.game.current_player
+            env.step(agents[p].act(env.observe(env.agents[p])))
+    return positions
+
+
+#
+# TESTS
+#
+
+def test_position_bank():
+    from BriscolaChiamata import BriscolaChiamataEnv
+    from RandomAgent import RandomAgent
+
+    env = BriscolaChiamataEnv()
+    env.seed(0)
+    positions = collect_positions(env, [RandomAgent(i) for i in range(env.game.np)], 2)
+    bank = PositionBank(positions, {'bidding': 0, 'choose_trump': 0})
+    assert (all(phase_of(bank.sample()).startswith('trick_') for i in range(20)))
+
+    # Consecutive resets draw different positions
+    env = BriscolaChiamataEnv(position_bank=bank)
+    env.seed(1)
+    drawn = []
+    for i in range(10):
+        env.reset()
+        drawn.append(json.dumps(env.game.get_state()))
+    assert (len(set(drawn)) > 1)
+
+
+if __name__ == "__main__":
+    test_position_bank()
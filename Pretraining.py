@@ -0,0 +1,316 @@
+#
+# Streaming data pipeline for supervised pretraining on recorded games.
+#
+# Games are stored as JSON lines (optionally gzipped), one game per line:
+#   {"deal": [41 ints, see DealBank], "actions": [flat action indexes, in order of play]}
+# e.g. games of a search agent or of humans. Records are streamed from disk, replayed
+# through the env to rebuild (observation, mask, action, return) samples, shuffled with
+# a bounded buffer and stacked in batches by worker processes, so that the data never
+# needs to fit in memory and the trainer never waits for it. Observations are flattened
+# in the layout seen by the models (MODEL_OBS_FIELDS), and actions index their logits.
+#
+import gzip
+import json
+import multiprocessing as mp
+import queue
+import random
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from BriscolaChiamata import BriscolaChiamataEnv, ACTION_OFFSETS, MODEL_OBS_FIELDS, flatten_action_mask, \
+    flatten_observation, action_from_index
+from Game import BidType, Deck, GameListener, GameState
+from Symmetry import symmetric_permutations
+
+
+def open_records(path, mode="r"):
+    if (path.endswith(".gz")):
+        return gzip.open(path, mode + "t")
+    return open(path, mode)
+
+
+class GameRecorder(GameListener):
+    """
+    Writes the games played in an env as records. Every step of the game is recorded, including
+    the bids and trump choice scripted by a trick_only env inside reset()
+    """
+
+    def __init__(self, path):
+        self.f = open_records(path, "w")
+        self.deal = None
+        self.actions = []
+
+    def close(self):
+        self.f.close()
+
+    def record_games(self, env, agents, n_games):
+        env.game.add_listener(self)
+        try:
+            for i in range(n_games):
+                env.reset()
+                while (not env.game.done):
+                    p = env.game.current_player
+                    env.step(agents[p].act(env.observe(env.agents[p])))
+                self.f.write(json.dumps({'deal': self.deal, 'actions': self.actions}) + "\n")
+        finally:
+            env.game.remove_listener(self)
+
+    def on_game_start(self, game):
+        # Also called when all players passed: the record starts from the new deal
+        self.deal = self.current_deal(game)
+        self.actions = []
+
+    def on_step(self, game, action, player):
+        if (hasattr(action, 'bid')):
+            if (all(b.type == BidType.NONE for b in game.bid_round)):
+                # Last pass before the cards were dealt again
+                return
+            bid = action.get_bid()
+            a = ACTION_OFFSETS[GameState.BIDDING] + (10 if (bid.type == BidType.PASS) else Deck.ranks.index(bid.rank))
+        elif (hasattr(action, 'trump')):
+            a = ACTION_OFFSETS[GameState.CHOOSE_TRUMP] + Deck.suits.index(action.get_trump())
+        else:
+            a = ACTION_OFFSETS[GameState.TRICK] + Deck.get_index_from_card(action.get_card())
+        self.actions.append(a)
+
+    @staticmethod
+    def current_deal(game):
+        # Hands are sorted when dealt, so the order of the cards within a hand does not matter
+        return [Deck.get_index_from_card(c) for p in game.players for c in p.hand] + [game.first_player]
+
+
+def read_records(paths, chunk_size=1000):
+    """
+    Streams the records of the files in paths, in chunks of chunk_size records
+    """
+    chunk = []
+    for path in paths:
+        with open_records(path) as f:
+            for line in f:
+                if (line.strip()):
+                    chunk.append(json.loads(line))
+                    if (len(chunk) == chunk_size):
+                        yield chunk
+                        chunk = []
+    if (chunk):
+        yield chunk
+
+
+def replay(env, record, augment=False, fields=MODEL_OBS_FIELDS):
+    """
+    Replays a record through env.
+    :param augment: if True, every sample is also returned in all its suit-permuted variants (see Symmetry)
+    :param fields: layout of the flat observations (see BriscolaChiamata.flatten_observation)
+    :return: list of (observation, mask, action, return) samples, one per decision, with flat arrays
+             and the final game points of the acting player as return
+    """
+    env.reset()
+    env.game.init_game(record['deal'])
+    env.agent_selection = env.agents[env.game.current_player]
+    perms = symmetric_permutations() if (augment) else None
+    steps = []
+    for a in record['actions']:
+        p = env.game.current_player
+        state = env.game.gamestate
+        obs = env.observe(env.agents[p])
+        action = action_from_index(a)
+        if (not flatten_action_mask(obs['action_mask'])[a]):
+            raise Exception("Illegal action {0} in record".format(a))
+        if (perms is None):
+            steps.append((p, flatten_observation(obs['observation'], fields), flatten_action_mask(obs['action_mask']),
+                          a))
+        else:
+            for perm in perms:
+                o = perm.observation(obs)
+                pa = perm.action(action)
+                steps.append((p, flatten_observation(o['observation'], fields), flatten_action_mask(o['action_mask']),
+                              ACTION_OFFSETS[state] + pa[state]))
+        env.step(action)
+    if (not env.game.done):
+        raise Exception("Incomplete game in record")
+    return [(x, m, a, float(env.game.game_points[p])) for p, x, m, a in steps]
+
+
+def samples(paths, augment=False, chunk_size=1000, fields=MODEL_OBS_FIELDS):
+    env = BriscolaChiamataEnv()
+    for chunk in read_records(paths, chunk_size):
+        for record in chunk:
+            for s in replay(env, record, augment, fields):
+                yield s
+
+
+def shuffle_buffer(iterable, size, rng):
+    """
+    Approximate shuffle of a stream with a bounded buffer of size elements
+    """
+    buf = []
+    for x in iterable:
+        if (len(buf) < size):
+            buf.append(x)
+        else:
+            i = rng.randrange(size)
+            yield buf[i]
+            buf[i] = x
+    rng.shuffle(buf)
+    for x in buf:
+        yield x
+
+
+def batches(iterable, batch_size):
+    """
+    Stacks (observation, mask, action, return) samples in dicts of arrays
+    """
+    buf = []
+    for s in iterable:
+        buf.append(s)
+        if (len(buf) == batch_size):
+            yield stack(buf)
+            buf = []
+    if (buf):
+        yield stack(buf)
+
+
+def stack(buf):
+    return {
+        'obs': np.stack([s[0] for s in buf]).astype(np.float32),
+        'mask': np.stack([s[1] for s in buf]),
+        'action': np.array([s[2] for s in buf], dtype=np.int64),
+        'ret': np.array([s[3] for s in buf], dtype=np.float32)
+    }
+
+
+class PrefetchError(Exception):
+    pass
+
+
+def _produce(paths, batch_size, buffer_size, augment, seed, fields, out):
+    try:
+        rng = random.Random(seed)
+        for b in batches(shuffle_buffer(samples(paths, augment, fields=fields), buffer_size, rng), batch_size):
+            out.put(b)
+    except Exception:
+        # Handed to the consumer, which raises it: the data must not be silently cut short
+        out.put(PrefetchError("Worker failed on {0}:\n{1}".format(paths, traceback.format_exc())))
+    finally:
+        out.put(None)
+
+
+class BatchPrefetcher:
+    """
+    Iterates over shuffled batches of samples built by n_workers workers, each streaming its own
+    share of the files, while the consumer trains on the previous batches.
+    :param use_threads: threads instead of processes (replay is pure Python: processes scale better)
+    :param fields: layout of the flat observations (by default, that of the models)
+    Errors of the workers are raised by the iteration, as PrefetchError.
+    """
+
+    def __init__(self, paths, batch_size=256, buffer_size=50000, n_workers=2, prefetch=8, augment=False,
+                 seed=0, use_threads=False, fields=MODEL_OBS_FIELDS):
+        self.paths = list(paths)
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.n_workers = max(1, min(n_workers, len(self.paths)))
+        self.prefetch = prefetch
+        self.augment = augment
+        self.seed = seed
+        self.use_threads = use_threads
+        self.fields = fields
+        self.samples = 0
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        if (self.use_threads):
+            out = queue.Queue(self.prefetch)
+            worker_cls = threading.Thread
+        else:
+            out = mp.Queue(self.prefetch)
+            worker_cls = mp.Process
+        workers = [worker_cls(target=_produce, daemon=True,
+                              args=(self.paths[i::self.n_workers], self.batch_size, self.buffer_size // self.n_workers,
+                                    self.augment, self.seed + i, self.fields, out))
+                   for i in range(self.n_workers)]
+        for w in workers:
+            w.start()
+        running = len(workers)
+        start = time.perf_counter()
+        try:
+            while (running > 0):
+                b = out.get()
+                if (b is None):
+                    running -= 1
+                    continue
+                if (isinstance(b, PrefetchError)):
+                    raise b
+                self.samples += len(b['action'])
+                self.elapsed = time.perf_counter() - start
+                yield b
+        finally:
+            if (not self.use_threads):
+                for w in workers:
+                    if (w.is_alive()):
+                        w.terminate()
+
+    def samples_per_sec(self):
+        return self.samples / self.elapsed if (self.elapsed > 0) else 0.0
+
+
+#
+# TESTS
+#
+
+def test_pretraining():
+    import os
+    import tempfile
+    from BriscolaChiamata import OBS_SIZE, TOTAL_ACTIONS
+    from RandomAgent import RandomAgent
+
+    np.random.seed(0)
+    d = tempfile.mkdtemp()
+    paths = [os.path.join(d, "games_{0}.jsonl.gz".format(i)) for i in range(2)]
+    env = BriscolaChiamataEnv()
+    env.seed(0)
+    decisions = 0
+    for path in paths:
+        recorder = GameRecorder(path)
+        recorder.record_games(env, [RandomAgent(i) for i in range(env.game.np)], 5)
+        recorder.close()
+        decisions += sum(len(r['actions']) for chunk in read_records([path]) for r in chunk)
+
+    # Every recorded decision comes back once, with a legal action
+    got = list(BatchPrefetcher(paths, batch_size=16, buffer_size=64, use_threads=True))
+    assert (sum(len(b['action']) for b in got) == decisions)
+    for b in got:
+        assert (b['obs'].shape[1] == OBS_SIZE and b['mask'].shape[1] == TOTAL_ACTIONS)
+        assert (b['mask'][np.arange(len(b['action'])), b['action']].all())
+        # Model layout: exactly one phase is set, at the slot of 'gamestate' among the sorted keys
+        start = sum(size for key, size in MODEL_OBS_FIELDS if (key < 'gamestate'))
+        assert (np.all(b['obs'][:, start:start + len(GameState)].sum(axis=1) == 1))
+
+    # The scripted bidding of a trick_only env is recorded too, so that its games replay from the deal
+    path = os.path.join(d, "trick_only.jsonl")
+    recorder = GameRecorder(path)
+    env = BriscolaChiamataEnv(trick_only=True)
+    env.seed(0)
+    recorder.record_games(env, [RandomAgent(i) for i in range(env.game.np)], 5)
+    recorder.close()
+    replay_env = BriscolaChiamataEnv()
+    for r in next(read_records([path])):
+        assert (len(replay(replay_env, r)) == len(r['actions']))
+
+    # Errors of the workers reach the consumer
+    bad = os.path.join(d, "bad.jsonl")
+    with open(bad, "w") as f:
+        record = next(read_records([paths[0]]))[0]
+        f.write(json.dumps(dict(record, actions=record['actions'][:-1])) + "\n")
+    try:
+        list(BatchPrefetcher([bad], use_threads=True))
+        assert False
+    except PrefetchError:
+        pass
+
+
+if __name__ == "__main__":
+    test_pretraining()
@@ -0,0 +1,312 @@
+#
+# Persistent, incremental ratings of the agent population.
+#
+# Game results are stored in a local SQLite database, and the rating of each agent
+# (a TrueSkill-like Gaussian: mu, sigma) is updated incrementally after every game,
+# the caller (with the partner, if any) playing as a team against the defenders.
+# Teams are compared by their mean skill per seat, and the advantage of a role (the
+# caller team wins less often than not, whoever plays it) is an offset estimated from
+# the outcomes of all the games, so that equal agents keep equal ratings.
+# Per-role aggregates are kept up to date as well, so that the leaderboard and the
+# caller / partner / defender breakdowns never need to scan the stored games.
+#
+import math
+import sqlite3
+import time
+from statistics import NormalDist
+
+import numpy as np
+
+MU = 25.0
+SIGMA = MU / 3
+BETA = SIGMA / 2
+TAU = SIGMA / 100
+MIN_SIGMA = 1e-3
+
+ROLES = ('caller', 'partner', 'defender')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS agents (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    mu REAL NOT NULL,
+    sigma REAL NOT NULL,
+    games INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    seed INTEGER,
+    caller_won INTEGER NOT NULL,
+    solo INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    game_id INTEGER NOT NULL,
+    seat INTEGER NOT NULL,
+    agent_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    game_points INTEGER NOT NULL,
+    PRIMARY KEY (game_id, seat)
+);
+CREATE INDEX IF NOT EXISTS results_agent ON results (agent_id, role);
+CREATE TABLE IF NOT EXISTS outcomes (
+    solo INTEGER PRIMARY KEY,
+    games INTEGER NOT NULL,
+    caller_wins INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS role_stats (
+    agent_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    games INTEGER NOT NULL,
+    wins INTEGER NOT NULL,
+    points INTEGER NOT NULL,
+    PRIMARY KEY (agent_id, role)
+);
+"""
+
+
+def _pdf(x):
+    return math.exp(-x * x / 2) / math.sqrt(2 * math.pi)
+
+
+def _cdf(x):
+    return 0.5 * (1 + math.erf(x / math.sqrt(2)))
+
+
+def roles_of(n_players, caller, partner):
+    return ['caller' if (i == caller) else 'partner' if (i == partner and partner != caller) else 'defender'
+            for i in range(n_players)]
+
+
+def team_update(ratings, winners, losers, prior=0.5):
+    """
+    Two-team TrueSkill update (no draws), the performance of a team being the mean of those of its seats.
+    :param ratings: dict agent -> (mu, sigma)
+    :param winners, losers: the agents of the two teams, one per seat (an agent may play several seats)
+    :param prior: probability that the winners would have won if all the agents were equal, accounting
+                  for the advantage of their role
+    :return: dict agent -> (mu, sigma) after the game; each agent gets a single update
+    """
+    # Weight of each agent in the difference between the mean performances of the two teams
+    coeff = dict((a, 0.0) for a in ratings)
+    for a in winners:
+        coeff[a] += 1.0 / len(winners)
+    for a in losers:
+        coeff[a] -= 1.0 / len(losers)
+    var = dict((a, s * s + TAU * TAU) for a, (m, s) in ratings.items())
+    c = math.sqrt(sum(coeff[a] ** 2 * var[a] for a in ratings) + BETA * BETA * (1.0 / len(winners) + 1.0 / len(losers)))
+    offset = c * NormalDist().inv_cdf(min(max(prior, 1e-6), 1 - 1e-6))
+    t = (sum(coeff[a] * m for a, (m, s) in ratings.items()) + offset) / c
+    # v and w of the truncated Gaussian; guard against underflow for very unlikely results
+    denom = _cdf(t)
+    v = _pdf(t) / denom if (denom > 1e-12) else -t
+    w = v * (v + t)
+    out = {}
+    for a, (m, s) in ratings.items():
+        new_mu = m + coeff[a] * var[a] / c * v
+        new_var = var[a] * max(1 - coeff[a] ** 2 * var[a] / (c * c) * w, MIN_SIGMA)
+        out[a] = (new_mu, math.sqrt(new_var))
+    return out
+
+
+class RatingStore:
+
+    def __init__(self, path="ratings.sqlite"):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.ids = {}
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def agent_id(self, name):
+        if (name not in self.ids):
+            self.conn.execute("INSERT OR IGNORE INTO agents (name, mu, sigma) VALUES (?, ?, ?)", (name, MU, SIGMA))
+            self.ids[name] = self.conn.execute("SELECT id FROM agents WHERE name = ?", (name,)).fetchone()[0]
+        return self.ids[name]
+
+    def rating(self, name):
+        row = self.conn.execute("SELECT mu, sigma FROM agents WHERE name = ?", (name,)).fetchone()
+        return (MU, SIGMA) if (row is None) else row
+
+    def record_game(self, agents, game_points, caller, partner, seed=None, commit=True):
+        """
+        :param agents: names of the agents, one per seat
+        :param game_points: Game.game_points
+        :param caller, partner: seats of the caller and of the partner (== caller in a solo game)
+        """
+        ids = [self.agent_id(a) for a in agents]
+        roles = roles_of(len(agents), caller, partner)
+        caller_won = game_points[caller] > 0
+        cur = self.conn.execute("INSERT INTO games (seed, caller_won, solo, created) VALUES (?, ?, ?, ?)",
+                                (seed, int(caller_won), int(caller == partner), time.time()))
+        game_id = cur.lastrowid
+        self.conn.executemany("INSERT INTO results (game_id, seat, agent_id, role, game_points) VALUES (?, ?, ?, ?, ?)",
+                              [(game_id, i, ids[i], roles[i], int(game_points[i])) for i in range(len(agents))])
+        self.conn.executemany(
+            "INSERT INTO role_stats (agent_id, role, games, wins, points) VALUES (?, ?, 1, ?, ?) "
+            "ON CONFLICT (agent_id, role) DO UPDATE SET games = games + 1, wins = wins + excluded.wins, "
+            "points = points + excluded.points",
+            [(ids[i], roles[i], int(game_points[i] > 0), int(game_points[i])) for i in range(len(agents))])
+
+        # Rating update, with the ratings of all the agents taken before the game
+        unique = list(dict.fromkeys(ids))
+        before = dict((r[0], (r[1], r[2])) for r in self.conn.execute(
+            "SELECT id, mu, sigma FROM agents WHERE id IN ({0})".format(",".join("?" * len(unique))), unique))
+        caller_team = [ids[i] for i in range(len(agents)) if (roles[i] != 'defender')]
+        defenders = [ids[i] for i in range(len(agents)) if (roles[i] == 'defender')]
+        p_caller = self.caller_win_prior(caller == partner)
+        if (caller_won):
+            after = team_update(before, caller_team, defenders, p_caller)
+        else:
+            after = team_update(before, defenders, caller_team, 1 - p_caller)
+        for agent in unique:
+            mu, sigma = after[agent]
+            self.conn.execute("UPDATE agents SET mu = ?, sigma = ?, games = games + 1 WHERE id = ?",
+                              (mu, max(sigma, MIN_SIGMA), agent))
+        self.conn.execute(
+            "INSERT INTO outcomes (solo, games, caller_wins) VALUES (?, 1, ?) "
+            "ON CONFLICT (solo) DO UPDATE SET games = games + 1, caller_wins = caller_wins + excluded.caller_wins",
+            (int(caller == partner), int(caller_won)))
+        if (commit):
+            self.conn.commit()
+        return game_id
+
+    def caller_win_prior(self, solo):
+        """
+        :return: the estimated probability that the caller team wins (solo or not), whoever plays the seats
+        """
+        row = self.conn.execute("SELECT games, caller_wins FROM outcomes WHERE solo = ?", (int(solo),)).fetchone()
+        games, wins = (0, 0) if (row is None) else row
+        return (wins + 1.0) / (games + 2.0)
+
+    def record_games(self, games):
+        """
+        Records many games in a single transaction.
+        :param games: iterable of (agents, game_points, caller, partner, seed) tuples
+        """
+        n = 0
+        with self.conn:
+            for g in games:
+                self.record_game(*g, commit=False)
+                n += 1
+        return n
+
+    def record_from_game(self, game, agents, seed=None):
+        return self.record_game(agents, game.game_points, game.caller, game.partner, seed)
+
+    def leaderboard(self, limit=None):
+        """
+        :return: list of (name, mu, sigma, games), sorted by the conservative estimate mu - 3 * sigma
+        """
+        q = "SELECT name, mu, sigma, games FROM agents ORDER BY mu - 3 * sigma DESC"
+        if (limit is not None):
+            q += " LIMIT {0:d}".format(limit)
+        return self.conn.execute(q).fetchall()
+
+    def role_breakdown(self, name):
+        """
+        :return: dict role -> {'games', 'wins', 'points', 'mean_points', 'win_rate'} for agent name
+                 (empty if the agent is unknown)
+        """
+        out = {}
+        # A plain lookup: only record_game creates agents
+        rows = self.conn.execute("SELECT r.role, r.games, r.wins, r.points FROM role_stats r "
+                                 "JOIN agents a ON a.id = r.agent_id WHERE a.name = ?", (name,))
+        for role, games, wins, points in rows:
+            out[role] = {'games': games, 'wins': wins, 'points': points,
+                         'mean_points': points / games, 'win_rate': wins / games}
+        return out
+
+    def informative_matchups(self, k=10, names=None):
+        """
+        :param names: agents to consider (default: all)
+        :return: the k pairs of agents whose games would be the most informative, as (name_a, name_b, score):
+                 pairs with uncertain ratings (high sigma) and close ratings (a game between them is not a foregone
+                 conclusion) come first
+        """
+        rows = self.conn.execute("SELECT name, mu, sigma FROM agents").fetchall()
+        if (names is not None):
+            names = set(names)
+            rows = [r for r in rows if (r[0] in names)]
+        if (len(rows) < 2):
+            return []
+        mu = np.array([r[1] for r in rows])
+        var = np.array([r[2] for r in rows]) ** 2
+        i, j = np.triu_indices(len(rows), 1)
+        s2 = 2 * BETA * BETA + var[i] + var[j]
+        quality = np.sqrt(2 * BETA * BETA / s2) * np.exp(-(mu[i] - mu[j]) ** 2 / (2 * s2))
+        score = quality * (var[i] + var[j])
+        best = np.argsort(-score)[:k]
+        return [(rows[i[b]][0], rows[j[b]][0], float(score[b])) for b in best]
+
+
+def record_evaluation(store, results, candidate, opponent):
+    """
+    Records the results of Evaluator.play_games: candidate sits at the seat of each result, opponent elsewhere
+    """
+    def games():
+        for r in results:
+            agents = [candidate if (i == r['seat']) else opponent for i in range(len(r['game_points']))]
+            yield agents, r['game_points'], r['caller'], r['partner'], r.get('seed')
+    return store.record_games(games())
+
+
+#
+# TESTS
+#
+
+def test_rating_store():
+    import os
+    import tempfile
+
+    store = RatingStore(os.path.join(tempfile.mkdtemp(), "ratings.sqlite"))
+    rng = np.random.default_rng(0)
+    games = []
+    for g in range(500):
+        agents = list(rng.permutation(['strong', 'weak', 'weak', 'weak', 'mid']))
+        caller, partner = rng.choice(5, 2, replace=True)
+        caller_team = {caller, partner}
+        # 'strong' wins whenever it plays, 'weak' loses whenever it plays with the caller
+        caller_won = ('strong' in [agents[i] for i in caller_team]) or \
+                     all(agents[i] != 'weak' for i in caller_team) and rng.random() < 0.5
+        if (caller == partner):
+            points = [4 if (i == caller) else -1 for i in range(5)]
+        else:
+            points = [2 if (i == caller) else 1 if (i == partner) else -1 for i in range(5)]
+        points = points if (caller_won) else [-x for x in points]
+        games.append((agents, points, int(caller), int(partner), g))
+    store.record_games(games)
+
+    board = [r[0] for r in store.leaderboard()]
+    assert (board[0] == 'strong' and board[-1] == 'weak')
+    breakdown = store.role_breakdown('strong')
+    assert (set(breakdown) <= set(ROLES) and sum(b['games'] for b in breakdown.values()) > 0)
+    assert (len(store.informative_matchups(2)) == 2)
+    # Queries never create agents
+    assert (store.role_breakdown('unknown') == {})
+    store.conn.commit()
+    assert ('unknown' not in [r[0] for r in store.leaderboard()])
+    store.close()
+
+    # Equal agents keep equal, stable ratings, even if the caller team wins less often than not
+    store = RatingStore(os.path.join(tempfile.mkdtemp(), "ratings.sqlite"))
+    for g in range(300):
+        seat = g % 5
+        caller, partner = rng.choice(5, 2, replace=True)
+        caller_won = rng.random() < 0.3
+        points = [(2 if (i == caller) else 1 if (i == partner) else -1) * (1 if (caller_won) else -1)
+                  for i in range(5)]
+        store.record_game(['candidate' if (i == seat) else 'random' for i in range(5)], points,
+                          int(caller), int(partner), g, commit=False)
+    store.conn.commit()
+    for name in ('candidate', 'random'):
+        assert (abs(store.rating(name)[0] - MU) < 3)
+    store.close()
+
+
+if __name__ == "__main__":
+    test_rating_store()
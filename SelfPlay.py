@@ -0,0 +1,409 @@
+#
+# Decoupled actor-learner self-play.
+#
+# Many actor processes play BriscolaChiamataEnv games: one seat is played by the current
+# learner policy, the others by opponents sampled from a pool of frozen past snapshots.
+# Actors write compact trajectories into slots of a shared memory buffer and pass the
+# slot indexes to the learner through a queue; the learner updates the policy and
+# periodically broadcasts the new weights through another shared memory block.
+#
+# Policies only need act(obs, mask, rng) -> (action, log-probability), get_weights() and
+# set_weights(w) on flat float arrays, plus learn(batch) for the learner. Trajectories
+# may come from older weights than the learner's: each step keeps the log-probability of
+# its action under the policy which played it, for off-policy corrections.
+#
+# LinearPolicy below is a small numpy stand-in implementing this interface: this pipeline
+# does not train the rllib ParametricActionsModel of train.py, which would need an adapter
+# exposing its weights and a learner step with the same interface.
+#
+import multiprocessing as mp
+import os
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from BriscolaChiamata import BriscolaChiamataEnv, TOTAL_ACTIONS, OBS_SIZE, flatten_action_mask, \
+    flatten_observation, action_from_index
+from Game import GameState, BidType
+
+# Upper bound to the decisions of a single player in a deal: bids, trump and 8 cards
+MAX_STEPS = 32
+
+
+class LinearPolicy:
+    """
+    Softmax policy, linear in the flattened observation, trained with REINFORCE, with truncated
+    importance weights (as in V-trace) correcting for the samples played by older weights
+    :param max_rho: upper bound to the importance weights
+    """
+
+    def __init__(self, lr=0.01, seed=0, max_rho=1.0):
+        self.lr = lr
+        self.max_rho = max_rho
+        rng = np.random.default_rng(seed)
+        self.w = rng.normal(0, 0.01, size=(OBS_SIZE + 1, TOTAL_ACTIONS))
+
+    def get_weights(self):
+        return self.w.reshape(-1).copy()
+
+    def set_weights(self, w):
+        self.w = np.asarray(w, dtype=np.float64).reshape(OBS_SIZE + 1, TOTAL_ACTIONS).copy()
+
+    def probs(self, obs, mask):
+        # obs: (N, OBS_SIZE), mask: (N, TOTAL_ACTIONS)
+        x = np.concatenate([obs, np.ones((obs.shape[0], 1), obs.dtype)], axis=1)
+        logits = np.where(mask, x @ self.w, -np.inf)
+        logits -= logits.max(axis=1, keepdims=True)
+        p = np.exp(logits)
+        return x, p / p.sum(axis=1, keepdims=True)
+
+    def act(self, obs, mask, rng):
+        _, p = self.probs(obs[None, :], mask[None, :])
+        a = rng.choice(TOTAL_ACTIONS, p=p[0])
+        return a, float(np.log(p[0, a]))
+
+    def learn(self, batch):
+        x, p = self.probs(batch['obs'], batch['mask'])
+        rows = np.arange(len(p))
+        actions = batch['action'].astype(np.int64)
+        # Importance weights of the current policy w.r.t. the one which played each step
+        rho = np.minimum(np.exp(np.log(p[rows, actions]) - batch['logp']), self.max_rho)
+        adv = batch['ret'] - batch['ret'].mean()
+        grad_logits = -p
+        grad_logits[rows, actions] += 1
+        self.w += self.lr * x.T @ (grad_logits * (rho * adv)[:, None]) / len(p)
+        return {'mean_return': float(batch['ret'].mean()), 'mean_rho': float(rho.mean())}
+
+
+class OpponentPool:
+    """
+    Frozen snapshots of past weights, stored as .npy files in a directory.
+    Snapshots are loaded once and kept in memory until the next refresh().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.snapshots = []
+        self.loaded = {}
+        self.refresh()
+
+    def refresh(self):
+        self.snapshots = sorted(f for f in os.listdir(self.path) if f.endswith(".npy"))
+        self.loaded.clear()
+
+    def add(self, weights, step):
+        name = "snapshot_{0:08d}.npy".format(step)
+        tmp = os.path.join(self.path, name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, weights)
+        os.replace(tmp, os.path.join(self.path, name))
+        self.snapshots.append(name)
+
+    def sample(self, rng):
+        """
+        :return: the weights of a snapshot drawn uniformly, or None if the pool is empty
+        """
+        if (len(self.snapshots) == 0):
+            return None
+        name = self.snapshots[rng.integers(len(self.snapshots))]
+        if (name not in self.loaded):
+            self.loaded[name] = np.load(os.path.join(self.path, name))
+        return self.loaded[name]
+
+
+class SharedArray:
+    """
+    numpy array backed by a SharedMemory block, attachable by name from other processes
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def spec(self):
+        return (self.shape, self.dtype.str, self.shm.name)
+
+    @staticmethod
+    def attach(spec):
+        return SharedArray(spec[0], spec[1], spec[2])
+
+    def close(self):
+        del self.array
+        self.shm.close()
+        if (self.owner):
+            self.shm.unlink()
+
+
+class TrajectoryQueue:
+    """
+    Fixed number of trajectory slots in shared memory: actors fill free slots and
+    pass their indexes to the learner, which hands them back once consumed.
+    Only the slot indexes go through the (pickling) multiprocessing queues.
+    """
+    FIELDS = {
+        'obs': ((MAX_STEPS, OBS_SIZE), np.float32),
+        'mask': ((MAX_STEPS, TOTAL_ACTIONS), np.bool_),
+        'action': ((MAX_STEPS,), np.int16),
+        'ret': ((MAX_STEPS,), np.float32),
+        # Log-probability of the action and version of the weights which played it
+        'logp': ((MAX_STEPS,), np.float32),
+        'version': ((MAX_STEPS,), np.int32),
+    }
+
+    def __init__(self, n_slots, specs=None, free=None, full=None):
+        self.n_slots = n_slots
+        if (specs is None):
+            self.arrays = {k: SharedArray((n_slots,) + shape, dtype) for k, (shape, dtype) in self.FIELDS.items()}
+            self.lengths = SharedArray((n_slots,), np.int32)
+            self.free = mp.Queue()
+            self.full = mp.Queue()
+            for i in range(n_slots):
+                self.free.put(i)
+        else:
+            self.arrays = {k: SharedArray.attach(s) for k, s in specs['arrays'].items()}
+            self.lengths = SharedArray.attach(specs['lengths'])
+            self.free = free
+            self.full = full
+
+    def handle(self):
+        """
+        :return: what an actor process needs to attach to the queue
+        """
+        specs = {'arrays': {k: a.spec() for k, a in self.arrays.items()}, 'lengths': self.lengths.spec()}
+        return self.n_slots, specs, self.free, self.full
+
+    @staticmethod
+    def attach(handle):
+        n_slots, specs, free, full = handle
+        return TrajectoryQueue(n_slots, specs, free, full)
+
+    def put(self, traj, timeout=None):
+        i = self.free.get(timeout=timeout)
+        n = len(traj['action'])
+        for k, a in self.arrays.items():
+            a.array[i, :n] = traj[k]
+        self.lengths.array[i] = n
+        self.full.put(i)
+
+    def get(self, timeout=None):
+        i = self.full.get(timeout=timeout)
+        n = self.lengths.array[i]
+        traj = {k: a.array[i, :n].copy() for k, a in self.arrays.items()}
+        self.free.put(i)
+        return traj
+
+    def close(self):
+        for a in self.arrays.values():
+            a.close()
+        self.lengths.close()
+
+
+class WeightBroadcast:
+    """
+    Latest learner weights in shared memory, with a version counter
+    """
+
+    def __init__(self, n_params, handle=None):
+        if (handle is None):
+            self.weights = SharedArray((n_params,), np.float64)
+            self.version = mp.Value('l', 0)
+        else:
+            spec, self.version = handle
+            self.weights = SharedArray.attach(spec)
+
+    def handle(self):
+        return self.weights.spec(), self.version
+
+    def publish(self, w):
+        with self.version.get_lock():
+            self.weights.array[:] = w
+            self.version.value += 1
+
+    def poll(self, version):
+        """
+        :return: (version, weights), weights being None if version is the current one
+        """
+        with self.version.get_lock():
+            if (self.version.value == version):
+                return version, None
+            return self.version.value, self.weights.array.copy()
+
+    def close(self):
+        self.weights.close()
+
+
+def play_game(env, policies, rng, learner_seat, version=0):
+    """
+    Plays a game where seat i is played by policies[i].
+    :param version: version of the weights of policies[learner_seat]
+    :return: the trajectory of learner_seat
+    """
+    env.reset()
+    obs_l, mask_l, action_l, logp_l = [], [], [], []
+    while (not env.game.done):
+        p = env.game.current_player
+        o = env.observe(env.agents[p])
+        x = flatten_observation(o['observation'])
+        m = flatten_action_mask(o['action_mask'])
+        a, logp = policies[p].act(x, m, rng)
+        if (p == learner_seat):
+            obs_l.append(x)
+            mask_l.append(m)
+            action_l.append(a)
+            logp_l.append(logp)
+        env.step(action_from_index(a))
+        if (env.game.gamestate == GameState.BIDDING and all(b.type == BidType.NONE for b in env.game.bid_round)):
+            # All players passed and the cards were dealt again: only the decisions of the last deal count
+            obs_l, mask_l, action_l, logp_l = [], [], [], []
+    ret = env.game.game_points[learner_seat]
+    return {
+        'obs': np.array(obs_l, np.float32),
+        'mask': np.array(mask_l, np.bool_),
+        'action': np.array(action_l, np.int16),
+        'ret': np.full(len(action_l), ret, np.float32),
+        'logp': np.array(logp_l, np.float32),
+        'version': np.full(len(action_l), version, np.int32)
+    }
+
+
+def actor_loop(actor_id, n_actors, seed, policy_factory, pool_path, traj_handle, weights_handle, stop):
+    trajectories = TrajectoryQueue.attach(traj_handle)
+    broadcast = WeightBroadcast(None, weights_handle)
+    pool = OpponentPool(pool_path)
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(actor_id,)))
+    env = BriscolaChiamataEnv(worker_index=actor_id, num_workers=n_actors)
+    env.seed(seed)
+    learner = policy_factory()
+    opponents = [policy_factory() for i in range(env.game.np)]
+    version = 0
+    games = 0
+    try:
+        while (not stop.is_set()):
+            version, w = broadcast.poll(version)
+            if (w is not None):
+                learner.set_weights(w)
+            if (games % 100 == 0):
+                pool.refresh()
+            seat = rng.integers(env.game.np)
+            policies = []
+            for i in range(env.game.np):
+                if (i == seat):
+                    policies.append(learner)
+                else:
+                    snapshot = pool.sample(rng)
+                    opponents[i].set_weights(learner.get_weights() if (snapshot is None) else snapshot)
+                    policies.append(opponents[i])
+            traj = play_game(env, policies, rng, seat, version)
+            games += 1
+            while (not stop.is_set()):
+                try:
+                    trajectories.put(traj, timeout=0.1)
+                    break
+                except queue.Empty:
+                    pass
+    finally:
+        trajectories.close()
+        broadcast.close()
+
+
+class ActorLearner:
+    """
+    :param policy_factory: picklable function with no arguments returning a new policy
+    :param n_actors: number of actor processes (default: one per core but one, left to the learner)
+    :param pool_path: directory of the opponent pool
+    :param snapshot_every: number of updates between snapshots added to the opponent pool
+    """
+
+    def __init__(self, policy_factory, n_actors=None, pool_path="opponent_pool", seed=0,
+                 games_per_update=64, snapshot_every=50, n_slots=None):
+        self.policy_factory = policy_factory
+        self.n_actors = max(1, (os.cpu_count() or 2) - 1) if (n_actors is None) else n_actors
+        self.pool = OpponentPool(pool_path)
+        self.seed = seed
+        self.games_per_update = games_per_update
+        self.snapshot_every = snapshot_every
+        self.n_slots = 4 * games_per_update if (n_slots is None) else n_slots
+        self.policy = policy_factory()
+        self.stats = {}
+
+    def run(self, n_updates, log_every=10):
+        ctx_stop = mp.Event()
+        w = self.policy.get_weights()
+        trajectories = TrajectoryQueue(self.n_slots)
+        broadcast = WeightBroadcast(len(w))
+        broadcast.publish(w)
+        actors = [mp.Process(target=actor_loop, daemon=True,
+                             args=(i, self.n_actors, self.seed, self.policy_factory, self.pool.path,
+                                   trajectories.handle(), broadcast.handle(), ctx_stop))
+                  for i in range(self.n_actors)]
+        for a in actors:
+            a.start()
+        start = time.perf_counter()
+        samples = 0
+        try:
+            for update in range(1, n_updates + 1):
+                batch = [self.next_trajectory(trajectories, actors) for i in range(self.games_per_update)]
+                batch = {k: np.concatenate([t[k] for t in batch]) for k in TrajectoryQueue.FIELDS}
+                samples += len(batch['action'])
+                # Weights version of the learner: each publish increments it, starting from the initial one
+                lag = update - batch['version']
+                info = self.policy.learn(batch)
+                broadcast.publish(self.policy.get_weights())
+                if (update % self.snapshot_every == 0):
+                    self.pool.add(self.policy.get_weights(), update)
+                elapsed = time.perf_counter() - start
+                self.stats = dict(info, update=update, samples=samples, samples_per_sec=samples / elapsed,
+                                  mean_policy_lag=float(lag.mean()))
+                if (update % log_every == 0):
+                    print("Update {update}: {samples} samples, {samples_per_sec:.0f} samples/sec".format(**self.stats))
+        finally:
+            ctx_stop.set()
+            for a in actors:
+                a.join(timeout=5)
+                if (a.is_alive()):
+                    a.terminate()
+            trajectories.close()
+            broadcast.close()
+        return self.stats
+
+    @staticmethod
+    def next_trajectory(trajectories, actors):
+        # Waits for a trajectory, failing instead of hanging if all the actors died
+        while True:
+            try:
+                return trajectories.get(timeout=1.0)
+            except queue.Empty:
+                if (not any(a.is_alive() for a in actors)):
+                    raise Exception("ActorLearner: all the actor processes exited")
+
+
+#
+# TESTS
+#
+
+def test_actor_learner():
+    import tempfile
+
+    pool = OpponentPool(tempfile.mkdtemp())
+    pool.add(np.zeros(3), 1)
+    rng = np.random.default_rng(0)
+    assert (pool.sample(rng) is pool.sample(rng))
+
+    learner = ActorLearner(LinearPolicy, n_actors=1, pool_path=tempfile.mkdtemp(), games_per_update=4,
+                           snapshot_every=1)
+    stats = learner.run(n_updates=2, log_every=100)
+    assert (stats['update'] == 2 and stats['samples'] > 0 and stats['mean_policy_lag'] >= 0)
+    assert (0 < stats['mean_rho'] <= 1)
+    learner.pool.refresh()
+    assert (len(learner.pool.snapshots) == 2)
+
+
+if __name__ == "__main__":
+    test_actor_learner()
@@ -0,0 +1,207 @@
+#
+# Suit symmetries of the game.
+#
+# Before the trump is chosen all the 4 suits are interchangeable; after it has been
+# chosen the 3 non-trump suits still are. The functions below map an information state
+# (and its action masks) to a canonical suit ordering and back, so that equivalent
+# states share the same representation (useful for caches and lookup tables), and
+# enumerate the symmetric variants of a sample (useful for data augmentation).
+#
+import itertools
+
+import numpy as np
+
+from Game import Deck, GameState
+
+N_SUITS = len(Deck.suits)
+N_RANKS = len(Deck.ranks)
+N_BIDS = N_RANKS + 1  # ranks + pass
+
+# Keys of the observation dict indexed by card (card index = suit * 10 + rank)
+# or by suit. They are the only ones affected by a suit permutation.
+CARD_OBS_KEYS = ('player_hand', 'current_trick', 'partner_card')
+SUIT_OBS_KEYS = ('trump', 'lead_suit')
+
+
+class SuitPermutation:
+    """
+    A relabelling of the suits: perm[s] is the suit that s is mapped to.
+    """
+
+    def __init__(self, perm):
+        self.perm = np.asarray(perm, dtype=np.int64)
+        self.inverse = np.argsort(self.perm)
+        # card_perm[i] is the index of the card i is mapped to
+        ranks = np.arange(N_RANKS)
+        self.card_perm = (self.perm[:, None] * N_RANKS + ranks[None, :]).reshape(-1)
+
+    @staticmethod
+    def identity():
+        return SuitPermutation(range(N_SUITS))
+
+    def inverted(self):
+        return SuitPermutation(self.inverse)
+
+    def is_identity(self):
+        return bool(np.all(self.perm == np.arange(N_SUITS)))
+
+    def suit(self, s):
+        return int(self.perm[s])
+
+    def card(self, i):
+        return int(self.card_perm[i])
+
+    def suit_array(self, a):
+        """
+        :param a: array indexed by suit along its last axis
+        :return: the permuted array
+        """
+        out = np.empty_like(a)
+        out[..., self.perm] = a
+        return out
+
+    def card_array(self, a):
+        """
+        :param a: array indexed by card along its last axis
+        :return: the permuted array
+        """
+        out = np.empty_like(a)
+        out[..., self.card_perm] = a
+        return out
+
+    def observation(self, obs):
+        """
+        :param obs: observation as returned by BriscolaChiamataEnv.observe
+        :return: a new observation with the suits relabelled
+        """
+        o = dict(obs['observation'])
+        for k in CARD_OBS_KEYS:
+            if (k in o):
+                o[k] = self.card_array(o[k])
+        for k in SUIT_OBS_KEYS:
+            if (k in o):
+                o[k] = self.suit_array(o[k])
+        return {'observation': o, 'action_mask': self.action_mask(obs['action_mask'])}
+
+    def action_mask(self, mask):
+        m = dict(mask)
+        m[GameState.CHOOSE_TRUMP] = self.suit_array(mask[GameState.CHOOSE_TRUMP])
+        m[GameState.TRICK] = self.card_array(mask[GameState.TRICK])
+        return m
+
+    def action(self, action):
+        """
+        :param action: action dict, as accepted by BriscolaChiamataEnv.step
+        :return: the action dict with the suits relabelled
+        """
+        a = dict(action)
+        a[GameState.CHOOSE_TRUMP] = self.suit(action[GameState.CHOOSE_TRUMP])
+        a[GameState.TRICK] = self.card(action[GameState.TRICK])
+        return a
+
+    def real_action(self, action):
+        """
+        Inverse of action(): maps an action chosen in the permuted space back to the real one
+        """
+        return self.inverted().action(action)
+
+    def logits(self, logits):
+        """
+        :param logits: array of action logits in the flat layout [bids | trump suits | cards] along its last axis
+        :return: the permuted logits
+        """
+        out = np.array(logits, copy=True)
+        out[..., N_BIDS:N_BIDS + N_SUITS] = self.suit_array(out[..., N_BIDS:N_BIDS + N_SUITS])
+        out[..., N_BIDS + N_SUITS:] = self.card_array(out[..., N_BIDS + N_SUITS:])
+        return out
+
+    def real_logits(self, logits):
+        """
+        Inverse of logits(): maps logits computed in the permuted space back to the real one
+        """
+        return self.inverted().logits(logits)
+
+
+def _suit_signature(game, player, si):
+    # Everything the player knows about suit si, without reference to its label.
+    # Two suits with the same signature can be swapped leaving the information state unchanged.
+    suit = Deck.suits[si]
+    is_trump = (game.trump is not None and game.trump == suit)
+    hand = tuple(sorted(c.card_rank() for c in game.get_player_hand(player) if c.suit == suit))
+    tricks = [t.cards for t in game.tricks] + [game.current_trick]
+    history = tuple((t, k, c.card_rank()) for t, cards in enumerate(tricks)
+                    for k, c in enumerate(cards) if c.suit == suit)
+    # Trump first, then the other suits
+    return (not is_trump, hand, history)
+
+
+def canonical_permutation(game, player):
+    """
+    :param game: a Game
+    :param player: the id of the observing player
+    :return: the SuitPermutation mapping the information state of player to its canonical form
+    """
+    order = sorted(range(N_SUITS), key=lambda si: _suit_signature(game, player, si))
+    perm = np.empty(N_SUITS, dtype=np.int64)
+    perm[order] = np.arange(N_SUITS)
+    return SuitPermutation(perm)
+
+
+def symmetric_permutations(trump=None):
+    """
+    :param trump: index of the trump suit, or None if it has not been chosen yet
+    :return: list of all the SuitPermutation leaving the game invariant (trump fixed, if any)
+    """
+    perms = []
+    for p in itertools.permutations(range(N_SUITS)):
+        if (trump is None or p[trump] == trump):
+            perms.append(SuitPermutation(p))
+    return perms
+
+
+def symmetric_variants(obs, action, trump=None):
+    """
+    Data augmentation: yields (obs, action) for every symmetric relabelling of the suits
+    """
+    for p in symmetric_permutations(trump):
+        yield p.observation(obs), p.action(action)
+
+
+#
+# TESTS
+#
+
+def test_canonical_permutation():
+    from Game import Game
+
+    game = Game()
+    game.seed(1)
+    game.init_game()
+    player = game.current_player
+    p = canonical_permutation(game, player)
+    hand = np.zeros(N_SUITS * N_RANKS, 'bool')
+    for c in game.get_player_hand(player):
+        hand[Deck.get_index_from_card(c)] = 1
+
+    # Relabelling the suits of the real game gives the same canonical hand
+    for q in symmetric_permutations():
+        relabelled = Game()
+        relabelled.seed(1)
+        relabelled.init_game()
+        for pl in relabelled.players:
+            pl.hand = [Deck.get_card_from_index(q.card(Deck.get_index_from_card(c))) for c in pl.hand]
+        r = canonical_permutation(relabelled, player)
+        assert (np.array_equal(r.card_array(q.card_array(hand)), p.card_array(hand)))
+
+    # Round trip of actions
+    action = {GameState.BIDDING: 3, GameState.CHOOSE_TRUMP: 2, GameState.TRICK: 27}
+    assert (p.real_action(p.action(action)) == action)
+
+    # Once the trump is chosen it is mapped to the first canonical suit
+    game.trump = Deck.suits[2]
+    assert (canonical_permutation(game, player).suit(2) == 0)
+    assert (len(symmetric_permutations(2)) == 6)
+
+
+if __name__ == "__main__":
+    test_canonical_permutation()
@@ -1,3 +1,6 @@
+import atexit
+import functools
+import os
 from abc import ABC
 
 import ray
@@ -6,9 +9,14 @@ from ray.rllib.env import PettingZooEnv
 from ray.rllib.models import ModelCatalog
 from ray.rllib.models.tf import TFModelV2, FullyConnectedNetwork
 from ray.rllib.utils import try_import_tf
-from ray.tune import register_env
+from ray.rllib.agents.ppo import PPOTrainer
+from ray.tune import register_env, Callback
 
 from BriscolaChiamata import BriscolaChiamataEnv
+from Evaluator import CheckpointEvaluator, flatten_metrics, load_rllib_agent
+from GameStats import GameStats
+from PositionBank import PositionBank
+from SelfPlay import ActorLearner, LinearPolicy
 
 tf1, tf, tfv = try_import_tf()
 
@@ -49,32 +57,103 @@ class ParametricActionsModel(TFModelV2):
 
 
 def env_creator(env_config):
-    return BriscolaChiamataEnv()  # return an env instance
+    position_bank = None
+    if ("position_bank" in env_config):
+        # Train from stored positions, e.g. {"position_bank": "positions.jsonl", "phase_weights": {"trick_6": 4}}
+        position_bank = PositionBank.load(env_config["position_bank"], env_config.get("phase_weights"))
+    # Each env gets its own random stream (or slice of the deal bank): one per vector env of each rollout worker.
+    # rllib keeps num_envs_per_worker in the trainer config: with a deal bank and vector envs it must be
+    # repeated in env_config, so that the slices of the bank do not overlap
+    worker_index = getattr(env_config, "worker_index", 0)
+    vector_index = getattr(env_config, "vector_index", 0)
+    listeners = []
+    if ("stats_dir" in env_config):
+        # Game statistics of each env, exported periodically (see GameStats.merge_exports)
+        os.makedirs(env_config["stats_dir"], exist_ok=True)
+        stats = GameStats(export_path=os.path.join(
+            env_config["stats_dir"], "stats_{0}_{1}.json".format(worker_index, vector_index)))
+        # rllib does not always close the envs of its workers: flush the last statistics at exit anyway
+        atexit.register(stats.close)
+        listeners.append(stats)
+    return BriscolaChiamataEnv(position_bank=position_bank,
+                               deal_bank=env_config.get("deal_bank"),
+                               worker_index=worker_index,
+                               num_workers=getattr(env_config, "num_workers", 0) + 1,
+                               vector_index=vector_index,
+                               num_envs_per_worker=env_config.get("num_envs_per_worker", 1),
+                               trick_only=env_config.get("trick_only", False),
+                               listeners=listeners)  # return an env instance
+
+
+def register():
+    register_env("BriscolaChiamata-v0", lambda config: PettingZooEnv(env_creator(config)))
+    ModelCatalog.register_custom_model("pa_model", ParametricActionsModel)
+
+
+def evaluation_setup():
+    # Runs in each (spawned) process of the CheckpointEvaluator, before restoring a checkpoint
+    if (not ray.is_initialized()):
+        ray.init(local_mode=True, include_dashboard=False)
+    register()
+
+
+BRISCOLA_CONFIG = {
+    "env": "BriscolaChiamata-v0",
+    "model": {
+        "custom_model": "pa_model"
+    },
+    "num_gpus": 0,
+    # "multiagent": {
+    #     "policies": set(env.agents),
+    #     "policy_mapping_fn": (lambda agent_id, episode, **kwargs: agent_id),
+    # },
+}
+
+
+class AsyncEvaluationCallback(Callback):
+    """
+    Adds the results of the background CheckpointEvaluator to the training results, as they become available
+    """
+
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+
+    def on_trial_result(self, iteration, trials, trial, result, **info):
+        for metrics in self.evaluator.poll():
+            result.update(flatten_metrics(metrics))
 
 
 def briscolaMain():
     ray.init(local_mode=True) # TODO: don't use local_mode for actual training
     env = env_creator({})
     # ray.rllib.utils.check_env(env)
-    register_env("BriscolaChiamata-v0", lambda config: PettingZooEnv(env_creator(config)))
-    ModelCatalog.register_custom_model("pa_model", ParametricActionsModel)
-    tune.run("PPO",
-             config={"env": "BriscolaChiamata-v0",
-                     "model": {
-                         "custom_model": "pa_model"
-                     },
-                     "evaluation_interval": 2,
-                     "evaluation_duration": 20,
-                     "num_gpus": 0,
-                     # "multiagent": {
-                     #     "policies": set(env.agents),
-                     #     "policy_mapping_fn": (lambda agent_id, episode, **kwargs: agent_id),
-                     # },
-                     },
-             local_dir="BriscolaChiamata-v0",
-             checkpoint_freq=2,
-             #resume=True # TODO: Uncomment when doing actual experiments
-             )
+    register()
+    # Checkpoints are evaluated in a separate process pool, without stalling training
+    eval_config = dict(BRISCOLA_CONFIG, num_workers=0, explore=False)
+    evaluator = CheckpointEvaluator(
+        "BriscolaChiamata-v0",
+        functools.partial(load_rllib_agent, trainer_cls=PPOTrainer, config=eval_config,
+                          setup=evaluation_setup),
+        opponents=("random",),
+        n_games=2000
+    ).start()
+    try:
+        tune.run("PPO",
+                 config=BRISCOLA_CONFIG,
+                 local_dir="BriscolaChiamata-v0",
+                 checkpoint_freq=2,
+                 callbacks=[AsyncEvaluationCallback(evaluator)],
+                 #resume=True # TODO: Uncomment when doing actual experiments
+                 )
+    finally:
+        evaluator.stop()
+
+
+def selfPlayMain():
+    # Actor-learner self-play against a pool of frozen snapshots, without rllib: LinearPolicy is a numpy
+    # stand-in, this does not train ParametricActionsModel
+    learner = ActorLearner(LinearPolicy, pool_path="BriscolaChiamata-v0/opponent_pool")
+    learner.run(n_updates=1000)
 
 
 def cartpoleMain():
@@ -91,4 +170,5 @@ def cartpoleMain():
 
 if __name__ == "__main__":
     briscolaMain()
+    # selfPlayMain()
     # cartpoleMain()